@@ -0,0 +1,113 @@
+# DBadd_bulk.py : CSV / NDJSON ファイルの行を既存のテーブルに追加する一括取り込みツール
+# テーブル全体を読み込んで to_sql(if_exists='replace') で書き直すのではなく、
+# ファイルを少しずつ読みながら BATCH_SIZE 行ごとに1トランザクションで executemany する（メモリ使用量は一定）。
+# 既存の行・インデックス・トリガー（etl_SQL.py の変更ログ）はそのまま残る。
+#   python DB_adddata/DBadd_bulk.py reservations new_reservations.csv
+#   python DB_adddata/DBadd_bulk.py stocks new_stocks.ndjson --db pop-make-up_DB_add.db --batch-size 20000
+# ファイルの列名（CSV はヘッダー行、NDJSON は各行のキー）はテーブルの列名と一致させる。空の値は NULL になる。
+# 取り込み後に python etl_SQL.py を実行すると、追加した予約だけが final_combined_data と集計テーブルに反映される
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Iterator
+
+DB_PATH = os.environ.get("DB_PATH", 'pop-make-up_DB_add.db')
+BATCH_SIZE = 10_000
+# 途中経過を表示する間隔（秒）
+PROGRESS_INTERVAL = 5.0
+
+
+def open_text(path: str):
+    """ファイルを開く関数（.gz で終わる場合は gzip として読む）"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def detect_format(path: str) -> str:
+    """拡張子からファイル形式（csv / ndjson）を判定する関数"""
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    if name.endswith(".csv"):
+        return "csv"
+    raise ValueError(f"Unknown file format: {path} (.csv / .ndjson / .jsonl)")
+
+
+def read_records(path: str, file_format: str) -> Iterator[dict]:
+    """ファイルの行を1件ずつ {列名: 値} で返すジェネレーター"""
+    with open_text(path) as file:
+        if file_format == "csv":
+            for record in csv.DictReader(file):
+                yield {key: (value if value != "" else None) for key, value in record.items()}
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> list:
+    """テーブルの列名の一覧を返す関数。テーブルがなければ ValueError"""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    if not columns:
+        raise ValueError(f"Table not found: {table}")
+    return columns
+
+
+def bulk_insert(conn: sqlite3.Connection, table: str, records: Iterator[dict], batch_size: int = BATCH_SIZE) -> int:
+    """
+    records をテーブルに追加し、追加した行数を返す関数。
+    列は最初の1件のキーで決める（テーブルにない列があれば ValueError）。batch_size 行ごとにコミットする
+    """
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return 0
+    columns = list(first)
+    unknown = [column for column in columns if column not in table_columns(conn, table)]
+    if unknown:
+        raise ValueError(f"Columns not in {table}: {', '.join(unknown)}")
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    insert_sql = f'INSERT INTO "{table}" ({column_list}) VALUES ({", ".join("?" * len(columns))})'
+
+    inserted = 0
+    started = reported = time.perf_counter()
+    batch = [tuple(first.get(column) for column in columns)]
+    for record in records:
+        batch.append(tuple(record.get(column) for column in columns))
+        if len(batch) >= batch_size:
+            with conn:
+                conn.executemany(insert_sql, batch)
+            inserted += len(batch)
+            batch.clear()
+            now = time.perf_counter()
+            if now - reported >= PROGRESS_INTERVAL:
+                print(f"  {inserted:,} 行 ({inserted / (now - started):,.0f} 行/秒)", file=sys.stderr)
+                reported = now
+    if batch:
+        with conn:
+            conn.executemany(insert_sql, batch)
+        inserted += len(batch)
+    return inserted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSV / NDJSON の行を既存のテーブルに追加する")
+    parser.add_argument("table", help="追加先のテーブル（reservations, stocks など）")
+    parser.add_argument("path", help="取り込むファイル（.csv / .ndjson / .jsonl、.gz 圧縮可）")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="1トランザクションで追加する行数")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    started = time.perf_counter()
+    count = bulk_insert(conn, args.table, read_records(args.path, detect_format(args.path)), args.batch_size)
+    elapsed = time.perf_counter() - started
+    conn.close()
+    print(f"{args.table} に {count:,} 行を追加しました（{elapsed:.2f} 秒, {count / elapsed if elapsed else 0:,.0f} 行/秒）")
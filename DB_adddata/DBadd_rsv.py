@@ -50,8 +50,8 @@ combined_df = pd.concat([existing_reservations_df, new_reservations_df], ignore_
 # 結合したデータフレームをデータベースに保存する前に、日付と時刻の列を文字列に変換
 combined_df['RSV_TIME'] = pd.to_datetime(combined_df['RSV_TIME']).dt.strftime('%Y-%m-%d')
 
-# 結合したデータフレームをデータベースに保存
-combined_df.to_sql('reservations', con=conn, if_exists='replace', index=False)
+# 追加分だけをデータベースに追加（テーブル全体を書き直さないので、既存のインデックスやトリガーは残る）
+new_reservations_df.to_sql('reservations', con=conn, if_exists='append', index=False)
 
 # Streamlitでデータフレームを表示
 st.write("結合したデータフレーム:", combined_df)
@@ -39,8 +39,8 @@ additional_data = pd.DataFrame({
 # 既存のデータと追加データを結合
 updated_stocks_df = pd.concat([stocks_df, additional_data], ignore_index=True)
 
-# 更新されたデータフレームをデータベースに保存
-updated_stocks_df.to_sql('stocks', con=conn, if_exists='replace', index=False)
+# 追加データだけをデータベースに追加（テーブル全体を書き直さないので、既存のインデックスは残る）
+additional_data.to_sql('stocks', con=conn, if_exists='append', index=False)
 
 # ここまでがstocksテーブルのDATE_IDを更新する処理
 
@@ -1,7 +1,7 @@
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 import streamlit as st
-from datetime import datetime
 
 # データベースへの接続
 engine = create_engine('sqlite:///pop-make-up_DB_add.db')
@@ -34,27 +34,6 @@ reservations_users_employee.drop(['HireDate'], axis=1, inplace=True)
 st.title('reservations_users/employee 結合')
 st.write(reservations_users_employee)
 
-# 現在の年を取得
-current_year = datetime.now().year
-
-# birthdayを年代別に変換し、不要なbirthdayカラムを削除
-def calculate_age_group(row):
-    birth_year = pd.to_datetime(row['birthday']).year
-    age = current_year - birth_year
-    if age < 30:
-        return '20代'
-    elif age < 40:
-        return '30代'
-    elif age < 50:
-        return '40代'
-    elif age < 60:
-        return '50代'
-    else:
-        return '60代以上'
-
-reservations_users_employee['age_group'] = reservations_users_employee.apply(calculate_age_group, axis=1)
-reservations_users_employee.drop(['birthday'], axis=1, inplace=True)
-
 # Streamlitアプリのタイトル
 st.title('ユーザー情報✖️予約情報の結合結果）')
 
@@ -77,6 +56,21 @@ st.write(stocks_stores_dates)
 # 最終的なデータフレームを作成し、不要なSTOCK_IDカラムを削除
 final_df = pd.merge(reservations_users_employee, stocks_stores_dates, left_on='STOCK_ID', right_on='ID_x').drop('ID_x_y', axis=1)
 
+# birthdayを年代別に変換し、不要なbirthdayカラムを削除
+# 年齢は今日ではなく利用日（DATE）の満年齢で計算する（列ごとにまとめて計算）
+# 日付を 20240105 のような整数にすると、満年齢は (利用日 - 生年月日) // 10000 になる（etl_SQL.py と同じ計算）
+# birthday は '1990-01-02' と '1990/1/2' の形式が混在しているので format='mixed' で読む（社員ごとの値を1回だけ変換する）
+# 年代コード: 2=20代（20歳未満を含む）, 3=30代, 4=40代, 5=50代, 6=60代以上（etl_SQL.py の AGE_GROUPS と同じ）
+def to_date_key(dates):
+    return dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day
+
+birthdays = final_df['birthday'].drop_duplicates()
+birth_keys = pd.Series(to_date_key(pd.to_datetime(birthdays, format='mixed')).values, index=birthdays.values)
+age = (to_date_key(pd.to_datetime(final_df['DATE'])) - final_df['birthday'].map(birth_keys)) // 10000
+final_df['age_code'] = np.select([age < 30, age < 40, age < 50, age < 60], [2, 3, 4, 5], default=6)
+final_df['age_group'] = final_df['age_code'].map({2: '20代', 3: '30代', 4: '40代', 5: '50代', 6: '60代以上'})
+final_df.drop(['birthday'], axis=1, inplace=True)
+
 # 最終的なデータフレームをStreamlitで表示
 st.title('結合データ')
 st.write(final_df)
@@ -1,25 +1,194 @@
-import streamlit as st
+# DB_st_test.py : SQLite のテーブルをページ単位で表示するビューアー
+# streamlit run DB_st_test.py で起動
+# テーブル全体を読み込むのではなく、選んだ列の1ページ分だけを SQL で取得する。
+#   ページ送り : 前のページの最後の行のキー（並べ替え列の値と rowid / 主キー）より後ろを LIMIT 件だけ読む（キーセット方式）。
+#                OFFSET と違い、後ろのページでも読み飛ばす行がないので速さは変わらない
+#   絞り込み・並べ替え : WHERE / ORDER BY にして SQL 側で処理する
+#   テーブル一覧・列・行数・表示したページ : st.cache_data でキャッシュし、ボタンなどの操作のたびに読み直さない
+
+import os
 import sqlite3
+from typing import Optional
 import pandas as pd
+import streamlit as st
+
+DB_PATH = os.environ.get("DB_PATH", 'pop-make-up_DB_add.db')
+# テーブル一覧・行数・ページのキャッシュを保持する秒数（ETL で更新されたデータはこの時間が経つと反映される）
+CACHE_TTL = 60
+PAGE_SIZES = [50, 100, 500, 1000]
+# 最初に表示する列の数（それ以外の列は「表示する列」で追加する）
+DEFAULT_COLUMNS = 8
+FILTER_OPERATORS = ["=", "!=", ">", ">=", "<", "<=", "LIKE"]
+
+
+@st.cache_resource
+def get_connection() -> sqlite3.Connection:
+    """読み取り専用の接続（Streamlit の再実行をまたいで使い回す）"""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+def quote(name: str) -> str:
+    """テーブル名・列名を SQL の識別子として囲む関数"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def list_tables() -> list:
+    """テーブル名の一覧"""
+    rows = get_connection().execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def table_schema(table: str) -> dict:
+    """テーブルの列名と、ページ送りに使うキー列（rowid、WITHOUT ROWID のテーブルは主キー）"""
+    conn = get_connection()
+    info = conn.execute(f"PRAGMA table_info({quote(table)})").fetchall()
+    columns = [row[1] for row in info]
+    try:
+        conn.execute(f"SELECT rowid FROM {quote(table)} LIMIT 0")
+        key_columns = ["rowid"]
+    except sqlite3.OperationalError:
+        key_columns = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+    return {"columns": columns, "key_columns": key_columns}
+
+
+def parse_value(text: str):
+    """絞り込みの値を数値に変換できれば数値にする関数（INTEGER の列と型を合わせるため）"""
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def build_where(filter_column: Optional[str], operator: str, value: str) -> tuple:
+    """絞り込みの条件を (WHERE句の条件のリスト, パラメータのリスト) にする関数"""
+    if not filter_column or value == "":
+        return [], []
+    return [f"{quote(filter_column)} {operator} ?"], [value if operator == "LIKE" else parse_value(value)]
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def count_rows(table: str, filter_column: Optional[str], operator: str, value: str) -> int:
+    """絞り込み後の行数"""
+    conditions, params = build_where(filter_column, operator, value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return get_connection().execute(f"SELECT COUNT(*) FROM {quote(table)} {where}", params).fetchone()[0]
+
+
+def keyset_condition(sort_column: Optional[str], descending: bool, key_columns: list, cursor: tuple) -> tuple:
+    """
+    前のページの最後の行（cursor = (並べ替え列の値, キー列の値...)）より後ろの行を表す条件を作る関数。
+    SQLite は NULL を昇順では先頭、降順では末尾に並べるので、並べ替え列が NULL の行も取りこぼさないようにする
+    """
+    op = "<" if descending else ">"
+    keys = "(" + ", ".join(quote(column) if column != "rowid" else column for column in key_columns) + ")"
+    key_params = list(cursor[1:])
+    placeholders = "(" + ", ".join("?" * len(key_columns)) + ")"
+    after_key = f"{keys} {op} {placeholders}"
+    if sort_column is None:
+        return after_key, key_params
+    column, last = quote(sort_column), cursor[0]
+    if last is None:
+        if descending:
+            return f"({column} IS NULL AND {after_key})", key_params
+        return f"(({column} IS NULL AND {after_key}) OR {column} IS NOT NULL)", key_params
+    condition = f"({column} {op} ? OR ({column} = ? AND {after_key})"
+    condition += f" OR {column} IS NULL)" if descending else ")"
+    return condition, [last, last] + key_params
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_page(
+    table: str, columns: tuple, sort_column: Optional[str], descending: bool,
+    filter_column: Optional[str], operator: str, value: str, cursor: Optional[tuple], page_size: int,
+) -> tuple:
+    """
+    1ページ分の行を読み、(表示用のデータフレーム, 次のページの cursor) を返す関数。
+    次のページがなければ cursor は None
+    """
+    key_columns = table_schema(table)["key_columns"]
+    conditions, params = build_where(filter_column, operator, value)
+    if cursor is not None:
+        condition, cursor_params = keyset_condition(sort_column, descending, key_columns, cursor)
+        conditions.append(condition)
+        params += cursor_params
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    direction = "DESC" if descending else "ASC"
+    order_columns = ([sort_column] if sort_column else []) + key_columns
+    order_by = ", ".join(f"{quote(column) if column != 'rowid' else column} {direction}" for column in order_columns)
+    # 表示する列の後ろに、次のページの cursor を作るための列（並べ替え列・キー列）を付けて読む
+    select = ", ".join([quote(column) for column in columns] + [
+        quote(column) if column != "rowid" else column for column in order_columns
+    ])
+    rows = get_connection().execute(
+        f"SELECT {select} FROM {quote(table)} {where} ORDER BY {order_by} LIMIT ?", params + [page_size + 1]
+    ).fetchall()
+
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = None
+    if has_next:
+        last = rows[-1][len(columns):]
+        next_cursor = tuple(last) if sort_column else (None, *last)
+    frame = pd.DataFrame([row[:len(columns)] for row in rows], columns=list(columns))
+    return frame, next_cursor
+
 
 # Streamlitアプリのタイトルを設定
 st.title('SQLite Database Viewer')
 
-# データベースに接続
-conn = sqlite3.connect('pop-make-up_DB_add.db')
+tables = list_tables()
+if not tables:
+    st.write(f"{DB_PATH} にテーブルがありません。")
+    st.stop()
+
+# 表示するテーブル・列・並べ替え・絞り込みの指定
+with st.sidebar:
+    table = st.selectbox("テーブル", tables)
+    schema = table_schema(table)
+    columns = st.multiselect("表示する列", schema["columns"], default=schema["columns"][:DEFAULT_COLUMNS])
+    sort_column = st.selectbox("並べ替え", [None] + schema["columns"], format_func=lambda column: column or "（既定の順）")
+    descending = st.checkbox("降順")
+    filter_column = st.selectbox("絞り込む列", [None] + schema["columns"], format_func=lambda column: column or "（なし）")
+    operator = st.selectbox("条件", FILTER_OPERATORS, disabled=filter_column is None)
+    value = st.text_input("値（LIKE は % を使える）", disabled=filter_column is None)
+    page_size = st.selectbox("1ページの行数", PAGE_SIZES)
+
+if not columns:
+    st.write("表示する列を選んでください。")
+    st.stop()
+
+# 指定が変わったら1ページ目に戻す。cursors には表示したページの開始位置（前のページの最後の行のキー）を積む
+view = (table, tuple(columns), sort_column, descending, filter_column, operator, value, page_size)
+if st.session_state.get("view") != view:
+    st.session_state.view = view
+    st.session_state.cursors = [None]
 
-# テーブル一覧を取得
-cursor = conn.cursor()
-cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-tables = cursor.fetchall()
+total = count_rows(table, filter_column, operator, value)
+frame, next_cursor = fetch_page(
+    table, tuple(columns), sort_column, descending, filter_column, operator, value,
+    st.session_state.cursors[-1], page_size,
+)
 
-# 各テーブルのデータをデータフレームに読み込み、それを表示
-for table_name in tables:
-    table_name = table_name[0]
-    st.subheader(f"Table: {table_name}")
-    query = f"SELECT * FROM {table_name}"
-    df = pd.read_sql_query(query, conn)
-    st.dataframe(df)
+page = len(st.session_state.cursors)
+st.subheader(f"Table: {table}")
+if frame.empty:
+    st.caption(f"{total:,} 行（該当する行はありません）")
+else:
+    st.caption(f"{total:,} 行中 {(page - 1) * page_size + 1:,}〜{(page - 1) * page_size + len(frame):,} 行目（{page} ページ）")
+st.dataframe(frame)
 
-# 接続を閉じる
-conn.close()
\ No newline at end of file
+previous_column, next_column = st.columns(2)
+if previous_column.button("前のページ", disabled=page == 1):
+    st.session_state.cursors.pop()
+    st.rerun()
+if next_column.button("次のページ", disabled=next_cursor is None):
+    st.session_state.cursors.append(next_cursor)
+    st.rerun()
@@ -1,64 +1,42 @@
 import pandas as pd
-from sqlalchemy import create_engine
 import streamlit as st
+from etl_SQL import (
+    FINAL_COMBINED_SHADOW, build_user_reservation_query, build_final_combined_query,
+    create_etl_engine, publish_final_combined, refresh_dimensions,
+)
+
+# データベースへの接続（WAL モード。書き込み中も API は読み取りを続けられる）
+engine = create_etl_engine('sqlite:///pop-make-up_DB_add.db')
 
-# データベースへの接続
-engine = create_engine('sqlite:///pop-make-up_DB_add.db')
 
 
+# 性別コード・年代コードの表（genders / age_groups）を先に用意する（処理①②はコードで結合する）
+with engine.begin() as conn:
+    refresh_dimensions(conn)
 
 # SQLクエリを使用して必要な結合とカラムの選択を行う。まずはユーザ情報の結合
-query_1 = """
-SELECT
-    r.id AS RSV_ID,
-    r.user_id,
-    r.stock_id,
-    -- u.employee_ID,
-    -- e.birthday,
-    e.Gender,
-    -- e.Department,
-    CASE 
-        WHEN strftime('%Y', 'now') - strftime('%Y', e.birthday) < 30 THEN '20代'
-        WHEN strftime('%Y', 'now') - strftime('%Y', e.birthday) < 40 THEN '30代'
-        WHEN strftime('%Y', 'now') - strftime('%Y', e.birthday) < 50 THEN '40代'
-        WHEN strftime('%Y', 'now') - strftime('%Y', e.birthday) < 60 THEN '50代'
-        ELSE '60代以上'
-    END AS age_group
-FROM reservations r
-JOIN users u ON r.user_id = u.id
-JOIN employee e ON u.employee_ID = e.employee_ID
-"""
+# （SQLは差分更新と共通にするため etl_SQL.py で定義）
+query_1 = build_user_reservation_query()
 
 # SQLクエリの結果をデータフレームとして読み込む
 df_1 = pd.read_sql_query(query_1, engine)
 
 # Streamlitアプリのタイトル
-st.title('ユーザー情報✖️予約情報の結合結果（年代別変換後）')
+st.title('ユーザー情報✖️予約情報の結合結果（性別コード・生年月日付き。年代は処理②で利用日時点の満年齢で計算）')
 
 # データフレームをStreamlitで表示
 st.write(df_1)
 
-# 処理②：お店情報、STOCK情報との結合のSQLクエリ
-query_2 = """
-SELECT
-    df_1.*,
-    -- st.PRD_ID,
-    s.STORE,
-    st.STORE_ID,
-    -- st.DATE_ID,
-    d.DATE,
-    d.WEEK
-FROM
-    ({query_1}) df_1
-JOIN stocks st ON df_1.stock_id = st.ID
-JOIN stores s ON st.STORE_ID = s.ID
-JOIN dates d ON st.DATE_ID = d.ID
-""".format(query_1=query_1)
+# 処理②：お店情報、STOCK情報との結合のSQLクエリ（整数の日付キー date_key / year_month / year_week と店舗・年代・性別のコードだけを持つ）
+query_2 = build_final_combined_query()
 
 # SQLクエリの結果をデータフレームとして読み込む
 df_2 = pd.read_sql_query(query_2, engine)
-# 最終結合データをデータベースに保存
-df_2.to_sql('final_combined_data', con=engine, if_exists='replace', index=False)
+# 最終結合データをシャドウテーブルに保存してから final_combined_data と入れ替える
+# （インデックス・API用の集計テーブル（月間サマリーなど）・差分更新のウォーターマークも同じトランザクションで更新）
+# 以降は python etl_SQL.py で新しい予約だけを差分更新できる
+df_2.to_sql(FINAL_COMBINED_SHADOW, con=engine, if_exists='replace', index=False)
+publish_final_combined(engine)
 
 # Streamlitアプリのタイトル（処理②の結果）
 st.title('最終結合データ')
@@ -67,7 +45,7 @@ st.title('最終結合データ')
 st.write(df_2)
 
 # 結合後のデータテーブルからダッシュボード用に
-# 計算処理を行う。
+# 計算処理を行う。（店舗名・日付などの表示名が付いた final_combined_data_labeled ビューを使う）
 
 # Streamlitアプリのタイトル（処理②の結果）
 st.title('ダッシュボード用計算処理:確認目的')
@@ -80,7 +58,7 @@ SELECT
     COUNT(DISTINCT user_id) AS Total_Users,  -- user_idの異なる値の数をカウントし、それをTotal_Usersとして集計します。これにより、各月のユニークな利用者数が求められます。
     COUNT(stock_id) AS Total_Stocks_Used     -- stock_idの総数をカウントし、Total_Stocks_Usedとして集計します。これにより、各月の総利用食数が求められます。
 FROM 
-    final_combined_data      -- final_combined_dataテーブルからデータを取得します。
+    final_combined_data_labeled      -- 表示名付きの final_combined_data からデータを取得します。
 GROUP BY
     strftime('%Y-%m', DATE)  -- DATEカラムから抽出した年月でグループ化し、月毎のデータを集計します。
 """
@@ -97,7 +75,7 @@ WITH UserWeeklyUsage AS (
         COUNT(DISTINCT strftime('%W', DATE)) AS WeeksUsed,
         COUNT(*) AS TotalUsage
     FROM
-        final_combined_data
+        final_combined_data_labeled
     GROUP BY
         user_id, Month
 ),
@@ -162,7 +140,7 @@ SELECT
     COUNT(DISTINCT user_id) AS Users_Per_Age_Group,
     COUNT(stock_id) AS Stocks_Used_Per_Age_Group
 FROM
-    final_combined_data
+    final_combined_data_labeled
 GROUP BY
     strftime('%Y-%m', DATE), age_group
 """
@@ -177,7 +155,7 @@ SELECT
     COUNT(DISTINCT user_id) AS Users_Per_Store,
     COUNT(stock_id) AS Stocks_Used_Per_Store
 FROM
-    final_combined_data
+    final_combined_data_labeled
 GROUP BY
     strftime('%Y-%m', DATE), STORE
 """
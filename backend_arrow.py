@@ -0,0 +1,314 @@
+# backend_arrow.py : 月ごとに分割した Parquet ファイルを pyarrow で集計するバックエンド
+# ETL の後に final_combined_data を列指向の Parquet（year_month=YYYYMM/ のディレクトリごとに1か月分）として書き出し、
+# API の集計（月間サマリー・使用頻度・店舗別/年代別）は必要な列と月のファイルだけを読んで pyarrow.compute で計算する。
+# main_SQL.py で ANALYTICS_BACKEND=arrow を指定すると SQL の代わりに使われる（レスポンスの形は SQL 版と同じ。要 pip install pyarrow）
+#   python etl_SQL.py --parquet      : ETL の後に書き出す
+#   python backend_arrow.py          : 現在の DB から書き出す
+# 書き出しは世代ごとのディレクトリ（gen-<ETL世代>/）に作成し、最後に _current.json を置き換えて切り替える。
+# 読み取り側は _current.json が変わったら新しいディレクトリを読む（書き出し途中のファイルは見えない）
+
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+from typing import Callable, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError as error:
+    raise ImportError("ANALYTICS_BACKEND=arrow と Parquet の書き出しには pyarrow が必要です（pip install pyarrow）") from error
+
+# Parquet を書き出すディレクトリ
+PARQUET_DIR = os.environ.get("PARQUET_DIR", "parquet")
+# 現在の書き出し先を指すファイル（{"generation": 12, "path": "gen-12", "total_users": 100}）
+MANIFEST_NAME = "_current.json"
+# DB から一度に読み込む行数
+EXPORT_BATCH_SIZE = 100_000
+
+# 書き出す列（集計に使う整数のキーとコードだけ。year_month はディレクトリ名で持つ）
+FACT_SCHEMA = pa.schema([
+    ("RSV_ID", pa.int64()),
+    ("user_id", pa.int64()),
+    ("stock_id", pa.int64()),
+    ("date_key", pa.int32()),
+    ("STORE_ID", pa.int32()),
+    ("age_code", pa.int8()),
+    ("gender_code", pa.int8()),
+    ("year_week", pa.int32()),
+    ("year_month", pa.int32()),
+])
+MONTH_PARTITIONING = ds.partitioning(pa.schema([("year_month", pa.int32())]), flavor="hive")
+
+# 使用頻度の分類（週平均の利用回数 1, 2, 3, 4, 5以上）
+USAGE_CATEGORIES = ['once', 'twice', 'thrice', 'four', 'five_plus']
+
+
+## 書き出し
+def read_fact_batches(conn: sqlite3.Connection):
+    """final_combined_data を EXPORT_BATCH_SIZE 行ずつ RecordBatch にして返すジェネレーター"""
+    columns = ", ".join(FACT_SCHEMA.names)
+    cursor = conn.execute(f"SELECT {columns} FROM final_combined_data ORDER BY year_month")
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(zip(*rows), FACT_SCHEMA)],
+            schema=FACT_SCHEMA,
+        )
+
+
+def export_parquet(db_path: str, out_dir: str = PARQUET_DIR) -> dict:
+    """
+    final_combined_data と表示名の次元テーブルを out_dir/gen-<ETL世代>/ に Parquet で書き出し、
+    _current.json を置き換えて公開する関数。公開した内容（_current.json の中身）を返す
+    """
+    # write_dataset は read_fact_batches を別のスレッドから（1つずつ順に）読むので check_same_thread=False にする
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    try:
+        generation = int(conn.execute("SELECT value FROM etl_state WHERE key = 'generation'").fetchone()[0])
+        name = f"gen-{generation}"
+        path = os.path.join(out_dir, name)
+        shutil.rmtree(path, ignore_errors=True)
+        ds.write_dataset(
+            read_fact_batches(conn), os.path.join(path, "facts"), schema=FACT_SCHEMA, format="parquet",
+            partitioning=MONTH_PARTITIONING, max_partitions=10_000,
+        )
+        for table, query in (
+            ("stores", "SELECT ID AS STORE_ID, STORE FROM stores"),
+            ("age_groups", "SELECT age_code, age_group FROM age_groups"),
+        ):
+            cursor = conn.execute(query)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            ds.write_dataset(
+                pa.table({column: list(values) for column, values in zip(columns, zip(*rows) if rows else [()] * 2)}),
+                os.path.join(path, table), format="parquet",
+            )
+        manifest = {
+            "generation": generation,
+            "path": name,
+            "total_users": conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    # 古い世代のディレクトリを削除する（読み取り中のファイルは OS が閉じるまで残す）
+    for entry in os.listdir(out_dir):
+        if entry.startswith("gen-") and entry != name:
+            shutil.rmtree(os.path.join(out_dir, entry), ignore_errors=True)
+    return manifest
+
+
+## 集計
+class ParquetSnapshot:
+    """1つの世代の Parquet ファイル。集計のたびに必要な列と月のファイルだけを読む"""
+
+    def __init__(self, out_dir: str, manifest: dict):
+        path = os.path.join(out_dir, manifest["path"])
+        self.facts = ds.dataset(os.path.join(path, "facts"), format="parquet", partitioning=MONTH_PARTITIONING)
+        stores = ds.dataset(os.path.join(path, "stores"), format="parquet").to_table()
+        self.store_names = dict(zip(stores["STORE_ID"].to_pylist(), stores["STORE"].to_pylist()))
+        age_groups = ds.dataset(os.path.join(path, "age_groups"), format="parquet").to_table()
+        self.age_labels = dict(zip(age_groups["age_code"].to_pylist(), age_groups["age_group"].to_pylist()))
+        self.total_users_count = manifest["total_users"]
+        self.generation = manifest["generation"]
+
+    def read(self, columns: list, months: pc.Expression) -> pa.Table:
+        """months（year_month の条件）に当てはまる月のファイルから columns の列だけを読む"""
+        return self.facts.to_table(columns=columns, filter=months)
+
+    def monthly_summary(self, from_key: int, to_key: int) -> list:
+        table = self.read(
+            ["year_month", "user_id"], (pc.field("year_month") >= from_key) & (pc.field("year_month") <= to_key)
+        )
+        grouped = table.group_by("year_month").aggregate([("user_id", "count_distinct"), ("user_id", "count")])
+        return sorted(
+            (
+                {"year_month": month, "Total_Users": users, "Total_Stocks_Used": meals}
+                for month, users, meals in zip(
+                    grouped["year_month"].to_pylist(),
+                    grouped["user_id_count_distinct"].to_pylist(),
+                    grouped["user_id_count"].to_pylist(),
+                )
+            ),
+            key=lambda row: row["year_month"],
+        )
+
+    def usage_frequency(self, year_month_keys: list) -> list:
+        table = self.read(["year_month", "user_id", "year_week"], pc.field("year_month").isin(year_month_keys))
+        # ユーザー×月ごとの利用回数と利用した週の数 → 週平均（整数除算）を 1〜5以上 の分類に変換して数える
+        per_user = table.group_by(["year_month", "user_id"]).aggregate(
+            [("year_week", "count_distinct"), ("user_id", "count")]
+        )
+        weekly = pc.divide(per_user["user_id_count"], per_user["year_week_count_distinct"])
+        category = pc.subtract(pc.min_element_wise(pc.max_element_wise(weekly, 1), 5), 1)
+        counts = pa.table({"year_month": per_user["year_month"], "category": category}).group_by(
+            ["year_month", "category"]
+        ).aggregate([("category", "count")])
+
+        result = []
+        totals = {}
+        for month, code, count in zip(
+            counts["year_month"].to_pylist(), counts["category"].to_pylist(), counts["category_count"].to_pylist()
+        ):
+            result.append({"year_month": month, "UsageCategory": USAGE_CATEGORIES[code], "UsersCount": count})
+            totals[month] = totals.get(month, 0) + count
+        # 週利用回数が0のユーザー数（データがない月は SQL 版と同じく None）
+        for month in year_month_keys:
+            zero = self.total_users_count - totals[month] if month in totals else None
+            result.append({"year_month": month, "UsageCategory": "zero", "UsersCount": zero})
+        return result
+
+    def group_summary(self, key: str, from_key: int, to_key: int) -> pa.Table:
+        """月 × key（STORE_ID / age_code）ごとの利用者数と利用食数"""
+        table = self.read(
+            ["year_month", key, "user_id"],
+            (pc.field("year_month") >= from_key) & (pc.field("year_month") <= to_key),
+        )
+        return table.group_by(["year_month", key]).aggregate([("user_id", "count_distinct"), ("user_id", "count")])
+
+    def store_summary(self, from_key: int, to_key: int) -> list:
+        grouped = self.group_summary("STORE_ID", from_key, to_key)
+        rows = [
+            {
+                "year_month": month,
+                "STORE": self.store_names.get(store_id),
+                "STORE_ID": store_id,
+                "Users_Per_Store": users,
+                "Stocks_Used_Per_Store": meals,
+            }
+            for month, store_id, users, meals in zip(
+                grouped["year_month"].to_pylist(),
+                grouped["STORE_ID"].to_pylist(),
+                grouped["user_id_count_distinct"].to_pylist(),
+                grouped["user_id_count"].to_pylist(),
+            )
+        ]
+        return sorted(rows, key=lambda row: (row["year_month"], row["STORE"]))
+
+    def age_groups_summary(self, from_key: int, to_key: int) -> list:
+        grouped = self.group_summary("age_code", from_key, to_key)
+        rows = sorted(zip(
+            grouped["year_month"].to_pylist(),
+            grouped["age_code"].to_pylist(),
+            grouped["user_id_count_distinct"].to_pylist(),
+            grouped["user_id_count"].to_pylist(),
+        ))
+        return [
+            {
+                "year_month": month,
+                "age_group": self.age_labels[age_code],
+                "Users_Per_Age_Group": users,
+                "Stocks_Used_Per_Age_Group": meals,
+            }
+            for month, age_code, users, meals in rows
+        ]
+
+
+def without_month(row: dict) -> dict:
+    return {key: value for key, value in row.items() if key != "year_month"}
+
+
+class ParquetNotReadyError(Exception):
+    """PARQUET_DIR に書き出した Parquet（_current.json）がない場合のエラー（API は 503 を返す）"""
+
+
+class ArrowBackend:
+    """
+    PARQUET_DIR の現在の世代（_current.json）を読み、変わっていれば開き直して集計するバックエンド。
+    Parquet の世代が DB の ETL 世代と違う間（ETL の後、書き出しが終わるまで）は fallback のバックエンドで集計する。
+    レスポンスキャッシュのキーは DB の ETL 世代なので、古い Parquet の結果を新しい世代として保存しないため
+    """
+
+    def __init__(self, fallback, out_dir: str = PARQUET_DIR):
+        self.fallback = fallback
+        self.out_dir = out_dir
+        self._snapshot = None
+        self._manifest_mtime = None
+
+    def snapshot(self) -> ParquetSnapshot:
+        manifest_path = os.path.join(self.out_dir, MANIFEST_NAME)
+        try:
+            mtime = os.stat(manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            raise ParquetNotReadyError(
+                f"No Parquet export found ({manifest_path}). "
+                "Run `python etl_SQL.py --parquet` or `python backend_arrow.py` first."
+            ) from None
+        if self._manifest_mtime != mtime:
+            with open(manifest_path) as file:
+                self._snapshot = ParquetSnapshot(self.out_dir, json.load(file))
+            self._manifest_mtime = mtime
+        return self._snapshot
+
+    async def current_snapshot(self) -> Optional[ParquetSnapshot]:
+        """DB の ETL 世代と同じ世代の Parquet を返す。世代が違えば None（fallback で集計する）"""
+        # ETL（etl_SQL.py --parquet）からの書き出しでは API 側のモジュールを読み込まないよう、ここで import する
+        from cache_SQL import get_generation
+
+        generation = await get_generation()
+        snapshot = await asyncio.to_thread(self.snapshot)
+        return snapshot if snapshot.generation == generation else None
+
+    @staticmethod
+    async def run(func: Callable, snapshot: ParquetSnapshot, *args):
+        """Parquet の読み込みと集計をワーカースレッドで実行する（pyarrow の計算中は GIL を解放する）"""
+        return await asyncio.to_thread(func, snapshot, *args)
+
+    async def monthly_summary(self, year_month_key: int, mapper: Callable) -> Optional[dict]:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.monthly_summary(year_month_key, mapper)
+        rows = await self.run(ParquetSnapshot.monthly_summary, snapshot, year_month_key, year_month_key)
+        return mapper(rows[0]) if rows else None
+
+    async def usage_frequency(self, year_month_key: int, prev_year_month_key: int) -> list:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.usage_frequency(year_month_key, prev_year_month_key)
+        return await self.run(ParquetSnapshot.usage_frequency, snapshot, [year_month_key, prev_year_month_key])
+
+    async def store_summary(self, year_month_key: int, mapper: Callable) -> list:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.store_summary(year_month_key, mapper)
+        rows = await self.run(ParquetSnapshot.store_summary, snapshot, year_month_key, year_month_key)
+        return [mapper(without_month(row)) for row in rows]
+
+    async def age_groups(self, year_month_key: int, mapper: Callable) -> list:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.age_groups(year_month_key, mapper)
+        rows = await self.run(ParquetSnapshot.age_groups_summary, snapshot, year_month_key, year_month_key)
+        return [mapper(without_month(row)) for row in rows]
+
+    async def monthly_summary_range(self, from_key: int, to_key: int) -> list:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.monthly_summary_range(from_key, to_key)
+        return await self.run(ParquetSnapshot.monthly_summary, snapshot, from_key, to_key)
+
+    async def store_summary_range(self, from_key: int, to_key: int) -> list:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.store_summary_range(from_key, to_key)
+        return await self.run(ParquetSnapshot.store_summary, snapshot, from_key, to_key)
+
+    async def age_groups_range(self, from_key: int, to_key: int) -> list:
+        snapshot = await self.current_snapshot()
+        if snapshot is None:
+            return await self.fallback.age_groups_range(from_key, to_key)
+        return await self.run(ParquetSnapshot.age_groups_summary, snapshot, from_key, to_key)
+
+
+if __name__ == "__main__":
+    manifest = export_parquet(os.environ.get("DB_PATH", 'pop-make-up_DB_add.db'))
+    print(f"{PARQUET_DIR}/{manifest['path']} に書き出しました（世代 {manifest['generation']}）。")
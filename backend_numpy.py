@@ -0,0 +1,206 @@
+# backend_numpy.py : NumPy による列指向の集計バックエンド
+# final_combined_data を ETL 世代ごとに1回だけ読み込み、整数コード化した NumPy 配列（列）としてメモリに保持する。
+# 3つの API の集計（月間サマリー・使用頻度・店舗別/年代別）を配列のベクトル演算で計算する。
+# main_SQL.py で ANALYTICS_BACKEND=numpy を指定すると SQL の代わりに使われる（レスポンスの形は SQL 版と同じ）
+
+import sqlite3
+from typing import Callable, Optional
+import numpy as np
+import db_SQL
+from cache_SQL import GenerationCachedValue
+
+# 使用頻度の分類（週平均の利用回数 1, 2, 3, 4, 5以上）
+USAGE_CATEGORIES = np.array(['once', 'twice', 'thrice', 'four', 'five_plus'])
+
+
+# final_combined_data から読み込む列と配列の型
+FACT_COLUMNS = [
+    ("year_month", np.int32),
+    ("year_week", np.int32),
+    ("user_id", np.int64),
+    ("STORE_ID", np.int64),
+    ("age_code", np.int64),
+]
+# DB から一度に読み込む行数
+LOAD_BATCH_SIZE = 100_000
+
+
+def load_fact_columns(conn: sqlite3.Connection) -> list:
+    """
+    final_combined_data の列を year_month 順に LOAD_BATCH_SIZE 行ずつ読み、
+    あらかじめ行数分だけ確保した NumPy 配列に詰めて返す関数（全行のタプルのリストを作らないため、メモリは配列の分だけで済む）
+    """
+    capacity = conn.execute("SELECT COUNT(*) FROM final_combined_data").fetchone()[0]
+    arrays = [np.empty(capacity, dtype=dtype) for _, dtype in FACT_COLUMNS]
+    columns = ", ".join(name for name, _ in FACT_COLUMNS)
+    cursor = conn.execute(f"SELECT {columns} FROM final_combined_data ORDER BY year_month")
+    size = 0
+    while True:
+        rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+        if not rows:
+            break
+        end = size + len(rows)
+        if end > capacity:
+            # 行数を数えた後に ETL で行が増えていた場合は配列を広げる
+            capacity = max(end, capacity * 2)
+            arrays = [np.resize(array, capacity) for array in arrays]
+        batch = np.array(rows, dtype=np.int64)
+        for index, array in enumerate(arrays):
+            array[size:end] = batch[:, index]
+        size = end
+    return [array[:size] for array in arrays]
+
+
+class ColumnarSnapshot:
+    """final_combined_data を整数コード化した列の集まり（year_month 順に並べて保持）"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        year_month, week, user_ids, store_ids, age_codes = load_fact_columns(conn)
+
+        self.year_month = year_month
+        self.week = week
+        # user_id・店舗・年代は 0 始まりの連番コードに変換し、表示名は次元テーブルから引いてラベル配列に持つ
+        self.user_ids, self.user = np.unique(user_ids, return_inverse=True)
+        self.store_ids, self.store = np.unique(store_ids, return_inverse=True)
+        store_names = dict(conn.execute("SELECT ID, STORE FROM stores").fetchall())
+        self.store_names = [store_names[int(store_id)] for store_id in self.store_ids]
+        age_codes, self.age = np.unique(age_codes, return_inverse=True)
+        age_labels = dict(conn.execute("SELECT age_code, age_group FROM age_groups").fetchall())
+        self.age_groups = np.array([age_labels[int(code)] for code in age_codes], dtype=object)
+
+        self.total_users_count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def month_slice(self, year_month_key: int) -> slice:
+        """指定月の行の範囲を二分探索で求める（配列は year_month 順）"""
+        start = np.searchsorted(self.year_month, year_month_key, side="left")
+        stop = np.searchsorted(self.year_month, year_month_key, side="right")
+        return slice(start, stop)
+
+    def months_between(self, from_key: int, to_key: int) -> list:
+        """from_key〜to_key の範囲でデータがある月のリストを返す"""
+        start = np.searchsorted(self.year_month, from_key, side="left")
+        stop = np.searchsorted(self.year_month, to_key, side="right")
+        return [int(month) for month in np.unique(self.year_month[start:stop])]
+
+    @staticmethod
+    def count_distinct(group: np.ndarray, values: np.ndarray, n_groups: int) -> np.ndarray:
+        """グループごとのユニークな値の数（COUNT(DISTINCT ...) ... GROUP BY）を計算する"""
+        if values.size == 0:
+            return np.zeros(n_groups, dtype=np.int64)
+        # (グループ, 値) の組を1つの整数にまとめて重複を除き、グループごとに数える
+        width = int(values.max()) + 1
+        pairs = np.unique(group.astype(np.int64) * width + values)
+        return np.bincount(pairs // width, minlength=n_groups)
+
+    def monthly_summary(self, year_month_key: int) -> Optional[dict]:
+        rows = self.month_slice(year_month_key)
+        users = self.user[rows]
+        if users.size == 0:
+            return None
+        return {
+            "Total_Users": int(np.unique(users).size),
+            "Total_Stocks_Used": int(users.size),
+        }
+
+    def usage_frequency(self, year_month_key: int) -> list:
+        rows = self.month_slice(year_month_key)
+        users, weeks = self.user[rows], self.week[rows]
+        result = []
+        if users.size:
+            # ユーザーごとの利用回数と利用した週の数
+            user_codes, user_index = np.unique(users, return_inverse=True)
+            total_usage = np.bincount(user_index)
+            weeks_used = self.count_distinct(user_index, weeks - weeks.min(), user_codes.size)
+            # 週平均（整数除算）を 1〜5以上 の分類に変換して数える
+            category = np.clip(total_usage // weeks_used, 1, 5) - 1
+            counts = np.bincount(category, minlength=USAGE_CATEGORIES.size)
+            result = [
+                {"year_month": year_month_key, "UsageCategory": str(name), "UsersCount": int(count)}
+                for name, count in zip(USAGE_CATEGORIES, counts)
+                if count
+            ]
+        # 週利用回数が0のユーザー数（データがない月は SQL 版と同じく None）
+        zero = self.total_users_count - sum(row["UsersCount"] for row in result) if result else None
+        result.append({"year_month": year_month_key, "UsageCategory": "zero", "UsersCount": zero})
+        return result
+
+    def store_summary(self, year_month_key: int) -> list:
+        rows = self.month_slice(year_month_key)
+        stores, users = self.store[rows], self.user[rows]
+        n_stores = self.store_ids.size
+        meals = np.bincount(stores, minlength=n_stores)
+        user_counts = self.count_distinct(stores, users, n_stores)
+        result = [
+            {
+                "STORE_ID": int(self.store_ids[code]),
+                "STORE": self.store_names[code],
+                "Users_Per_Store": int(user_counts[code]),
+                "Stocks_Used_Per_Store": int(meals[code]),
+            }
+            for code in np.flatnonzero(meals)
+        ]
+        return sorted(result, key=lambda row: row["STORE"])
+
+    def age_groups_summary(self, year_month_key: int) -> list:
+        rows = self.month_slice(year_month_key)
+        ages, users = self.age[rows], self.user[rows]
+        n_ages = self.age_groups.size
+        meals = np.bincount(ages, minlength=n_ages)
+        user_counts = self.count_distinct(ages, users, n_ages)
+        return [
+            {
+                "age_group": str(self.age_groups[code]),
+                "Users_Per_Age_Group": int(user_counts[code]),
+                "Stocks_Used_Per_Age_Group": int(meals[code]),
+            }
+            for code in np.flatnonzero(meals)
+        ]
+
+
+class NumpyBackend:
+    """ColumnarSnapshot を ETL 世代が変わるたびに読み直して集計するバックエンド"""
+
+    def __init__(self):
+        self._snapshot = GenerationCachedValue(lambda: db_SQL.run_in_pool(ColumnarSnapshot))
+
+    async def snapshot(self) -> ColumnarSnapshot:
+        """現在の ETL 世代のスナップショットを返す。世代が変わっていればワーカースレッドで読み直す"""
+        return await self._snapshot.get()
+
+    async def monthly_summary(self, year_month_key: int, mapper: Callable) -> Optional[dict]:
+        row = (await self.snapshot()).monthly_summary(year_month_key)
+        return mapper(row) if row else None
+
+    async def usage_frequency(self, year_month_key: int, prev_year_month_key: int) -> list:
+        snapshot = await self.snapshot()
+        return snapshot.usage_frequency(year_month_key) + snapshot.usage_frequency(prev_year_month_key)
+
+    async def store_summary(self, year_month_key: int, mapper: Callable) -> list:
+        return [mapper(row) for row in (await self.snapshot()).store_summary(year_month_key)]
+
+    async def age_groups(self, year_month_key: int, mapper: Callable) -> list:
+        return [mapper(row) for row in (await self.snapshot()).age_groups_summary(year_month_key)]
+
+    # 月の範囲：スナップショット内の月ごとの範囲（year_month 順）を順に集計する
+    async def monthly_summary_range(self, from_key: int, to_key: int) -> list:
+        snapshot = await self.snapshot()
+        rows = []
+        for month in snapshot.months_between(from_key, to_key):
+            rows.append({"year_month": month, **snapshot.monthly_summary(month)})
+        return rows
+
+    async def store_summary_range(self, from_key: int, to_key: int) -> list:
+        snapshot = await self.snapshot()
+        return [
+            {"year_month": month, **row}
+            for month in snapshot.months_between(from_key, to_key)
+            for row in snapshot.store_summary(month)
+        ]
+
+    async def age_groups_range(self, from_key: int, to_key: int) -> list:
+        snapshot = await self.snapshot()
+        return [
+            {"year_month": month, **row}
+            for month in snapshot.months_between(from_key, to_key)
+            for row in snapshot.age_groups_summary(month)
+        ]
@@ -0,0 +1,58 @@
+# bench_serialization.py : /usage-group のレスポンス1件あたりの JSON 変換コストを比較するマイクロベンチマーク
+#   python benchmarks/bench_serialization.py [YYYYMM]
+# 1. FastAPI の既定（jsonable_encoder + JSONResponse の json.dumps）
+# 2. orjson で直接バイト列に変換（orjson がある場合）
+# 3. 変換済みの本文（キャッシュ・スナップショット）をそのまま Response にする場合
+
+import asyncio
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+def load_payload(year_month: str) -> dict:
+    """DB から /usage-group のレスポンスを計算する。DB が使えない場合は group_data.json のダミーを使う"""
+    try:
+        import db_SQL
+        import main_SQL
+        payload = asyncio.run(main_SQL.compute_usage_group(year_month))
+        db_SQL.shutdown()
+        return payload
+    except Exception as error:
+        print(f"DB から計算できないため group_data.json を使います: {error}")
+        with open("group_data.json", "r") as file:
+            return json.load(file)[year_month]
+
+
+def measure(label: str, func, number: int) -> dict:
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{label:<40} {seconds * 1e6:8.2f} µs/リクエスト")
+    return {"label": label, "us_per_request": round(seconds * 1e6, 3)}
+
+
+def main(year_month: str = "202401", number: int = 20000) -> list:
+    payload = load_payload(year_month)
+    body = JSONResponse(jsonable_encoder(payload)).body
+    print(f"/usage-group/{year_month}: {len(body)} バイト")
+
+    results = [
+        measure("FastAPI 既定 (jsonable_encoder + json)", lambda: JSONResponse(jsonable_encoder(payload)), number),
+    ]
+    try:
+        import orjson
+        results.append(measure("orjson.dumps", lambda: Response(orjson.dumps(payload), media_type="application/json"), number))
+    except ImportError:
+        print("orjson がインストールされていないため省略します")
+    results.append(measure("変換済みの本文 (キャッシュ/スナップショット)", lambda: Response(body, media_type="application/json"), number))
+    return results
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
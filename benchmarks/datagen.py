@@ -0,0 +1,176 @@
+# datagen.py : 負荷試験用のダミーDBを作成する
+# 本番と同じ元テーブル（employee / users / stores / dates / stocks / reservations）を乱数で生成し、
+# etl_SQL.py の全件再作成で final_combined_data と集計テーブルまで作る。seed が同じなら同じデータになる。
+#   python benchmarks/datagen.py --scale 1 --seed 0 --out benchmarks/data/bench_1x.db
+#
+# スケール: 1x = 予約10万件・ユーザー100人、10x = 100万件・1,000人、100x = 1,000万件・10,000人
+# 予約日は平日に多く（金曜は少し少なめ）、土日はほとんどない。ユーザーごとに利用頻度（週1〜5回）の傾向を持たせる
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASE_RESERVATIONS = 100_000
+BASE_USERS = 100
+STORES = ['品川本社', '札幌支社', '静岡支社', '名古屋支社', '恵比寿支社', '仙台支社', '広島支社', '福岡支社', '浅草支社']
+WEEKDAYS = ['月', '火', '水', '木', '金', '土', '日']
+# 曜日ごとの予約の重み（月〜日）
+WEEKDAY_WEIGHTS = np.array([1.0, 1.0, 1.0, 1.0, 0.8, 0.05, 0.02])
+# 本社に予約が集中する傾向（店舗ごとの重み）
+STORE_WEIGHTS = np.array([8.0, 1, 1, 1, 1, 1, 1, 1, 1])
+PRODUCTS_PER_STORE_DAY = 5
+START_DATE = date(2021, 1, 1)
+END_DATE = date(2024, 12, 31)
+BATCH_SIZE = 50_000
+
+SCHEMA = """
+CREATE TABLE employee (
+    "employee_ID" INTEGER NOT NULL,
+    "LastName" TEXT,
+    "FirstName" TEXT,
+    "Gender" TEXT,
+    "birthday" DATE NOT NULL,
+    "HireDate" DATE NOT NULL,
+    "Department" TEXT NOT NULL,
+    PRIMARY KEY("employee_ID")
+);
+CREATE TABLE users (
+    "ID" INTEGER NOT NULL UNIQUE,
+    "USER_NAME" VARCHAR(100) NOT NULL,
+    "EMAIL" VARCHAR(100),
+    "PASSWORD" VARCHAR(100) NOT NULL,
+    "IS_ACTIVE" BOOLEAN,
+    "employee_ID" INTEGER NOT NULL,
+    PRIMARY KEY("ID")
+);
+CREATE TABLE stores (
+    "ID" INTEGER NOT NULL UNIQUE,
+    "STORE" VARCHAR(20) NOT NULL,
+    PRIMARY KEY("ID")
+);
+CREATE TABLE dates (
+    "ID" INTEGER NOT NULL UNIQUE,
+    "DATE" DATE NOT NULL,
+    "WEEK" VARCHAR(20),
+    PRIMARY KEY("ID")
+);
+CREATE TABLE stocks (
+    "ID" INTEGER,
+    "PRD_ID" INTEGER,
+    "STORE_ID" INTEGER,
+    "DATE_ID" INTEGER,
+    "LOT" TEXT,
+    "BEST_BY_DAY" TEXT,
+    "PIECES" REAL
+);
+CREATE TABLE reservations (
+    "ID" INTEGER,
+    "USER_ID" INTEGER,
+    "STOCK_ID" INTEGER,
+    "MY_COUPON_ID" INTEGER,
+    "RSV_TIME" TEXT,
+    "MET" INTEGER
+);
+"""
+
+
+def insert_batches(conn: sqlite3.Connection, sql: str, rows) -> None:
+    """rows（行のイテレータ）を BATCH_SIZE 件ずつ executemany で挿入する"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            batch.clear()
+    if batch:
+        conn.executemany(sql, batch)
+
+
+def generate(path: str, scale: float, seed: int) -> dict:
+    """ダミーDBを作成し、作成した件数を返す関数"""
+    rng = np.random.default_rng(seed)
+    n_users = max(1, int(BASE_USERS * scale))
+    n_reservations = int(BASE_RESERVATIONS * scale)
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+
+    # 社員・ユーザー（ユーザー1人 = 社員1人）
+    employee_ids = 10_000_000 + rng.choice(89_999_999, size=n_users, replace=False)
+    birth_days = rng.integers(date(1960, 1, 1).toordinal(), date(2002, 12, 31).toordinal(), size=n_users)
+    genders = rng.choice(['男性', '女性'], size=n_users)
+    insert_batches(conn, "INSERT INTO employee VALUES (?, ?, ?, ?, ?, ?, ?)", (
+        (int(employee_ids[i]), f"姓{i}", f"名{i}", str(genders[i]),
+         date.fromordinal(int(birth_days[i])).isoformat(), '2010-04-01', '営業部')
+        for i in range(n_users)
+    ))
+    insert_batches(conn, "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", (
+        (i + 1, f"user{i + 1}", f"user{i + 1}@example.com", "password", 1, int(employee_ids[i]))
+        for i in range(n_users)
+    ))
+
+    # 店舗・日付
+    conn.executemany("INSERT INTO stores VALUES (?, ?)", list(enumerate(STORES, start=1)))
+    n_days = (END_DATE - START_DATE).days + 1
+    days = [START_DATE + timedelta(days=i) for i in range(n_days)]
+    conn.executemany("INSERT INTO dates VALUES (?, ?, ?)", [
+        (i + 1, day.isoformat(), WEEKDAYS[day.weekday()]) for i, day in enumerate(days)
+    ])
+
+    # 在庫：日付 × 店舗 × 商品ごとに1行（ID = ((日付-1) × 店舗数 + (店舗-1)) × 商品数 + 商品）
+    n_stores = len(STORES)
+    insert_batches(conn, "INSERT INTO stocks VALUES (?, ?, ?, ?, NULL, NULL, 10.0)", (
+        ((date_id - 1) * n_stores * PRODUCTS_PER_STORE_DAY + (store_id - 1) * PRODUCTS_PER_STORE_DAY + product,
+         product, store_id, date_id)
+        for date_id in range(1, n_days + 1)
+        for store_id in range(1, n_stores + 1)
+        for product in range(1, PRODUCTS_PER_STORE_DAY + 1)
+    ))
+
+    # 予約：曜日の重みで日付を、利用頻度の傾向（週1〜5回）の重みでユーザーを選ぶ
+    day_weights = WEEKDAY_WEIGHTS[[day.weekday() for day in days]]
+    user_weights = rng.choice([1, 2, 3, 4, 5], size=n_users, p=[0.4, 0.3, 0.15, 0.1, 0.05]).astype(float)
+    date_ids = rng.choice(n_days, size=n_reservations, p=day_weights / day_weights.sum()) + 1
+    user_ids = rng.choice(n_users, size=n_reservations, p=user_weights / user_weights.sum()) + 1
+    store_ids = rng.choice(n_stores, size=n_reservations, p=STORE_WEIGHTS / STORE_WEIGHTS.sum()) + 1
+    products = rng.integers(1, PRODUCTS_PER_STORE_DAY + 1, size=n_reservations)
+    stock_ids = ((date_ids - 1) * n_stores + (store_ids - 1)) * PRODUCTS_PER_STORE_DAY + products
+    coupons = rng.integers(1000, 9999, size=n_reservations)
+    met = rng.integers(0, 2, size=n_reservations)
+    # 予約IDは日付順に振る（新しい予約ほどIDが大きい）
+    order = np.argsort(date_ids, kind="stable")
+    insert_batches(conn, "INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?)", (
+        (rsv_id, int(user_ids[i]), int(stock_ids[i]), int(coupons[i]), days[date_ids[i] - 1].isoformat(), int(met[i]))
+        for rsv_id, i in enumerate(order, start=1)
+    ))
+    conn.commit()
+    conn.close()
+    return {"users": n_users, "reservations": n_reservations, "days": n_days, "stores": n_stores}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="負荷試験用のダミーDBを作成する")
+    parser.add_argument("--scale", type=float, default=1, help="1 = 予約10万件・ユーザー100人（10, 100 で10倍, 100倍）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="出力するDBファイル（省略時 benchmarks/data/bench_{scale}x.db）")
+    args = parser.parse_args()
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", f"bench_{args.scale:g}x.db")
+
+    started = time.perf_counter()
+    counts = generate(out, args.scale, args.seed)
+    print(f"元テーブルを作成しました: {counts} ({time.perf_counter() - started:.1f} 秒)")
+
+    # final_combined_data と API 用の集計テーブルを作成
+    from etl_SQL import create_etl_engine, run_full_refresh
+    started = time.perf_counter()
+    run_full_refresh(create_etl_engine(f"sqlite:///{out}"))
+    print(f"ETL（全件再作成）が完了しました: {out} ({time.perf_counter() - started:.1f} 秒)")
@@ -0,0 +1,179 @@
+# loadtest.py : API の負荷試験（エンドポイントごとのレイテンシ p50/p95/p99 とスループット）
+# main_SQL.py の app を httpx.ASGITransport でプロセス内から呼び出す（サーバーの起動やネットワークは不要）。
+# 結果は benchmarks/results/{コミット}.json に保存し、--compare で2つの結果を比べて劣化を確認できる。
+#   python benchmarks/datagen.py --scale 10                                      : 試験用のDBを作成
+#   python benchmarks/loadtest.py --db benchmarks/data/bench_10x.db -n 500 -c 16
+#   python benchmarks/loadtest.py --no-cache ...                                 : レスポンスキャッシュなし（毎回集計）
+#   python benchmarks/loadtest.py --compare results/old.json results/new.json  : 結果の比較
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+sys.path.insert(0, ROOT)
+
+# 試験するエンドポイント: 名前 -> (月の一覧と乱数から URL を作る関数)
+ENDPOINTS = {
+    "monthly-summary": lambda months, rng: f"/monthly-summary/{rng.choice(months)}",
+    "usage-frequency": lambda months, rng: f"/usage-frequency/{rng.choice(months)}",
+    "usage-group": lambda months, rng: f"/usage-group/{rng.choice(months)}",
+    "dashboard": lambda months, rng: f"/dashboard/{rng.choice(months)}",
+    "monthly-summary-range": lambda months, rng: "/monthly-summary?from={}&to={}".format(*month_range(months, rng)),
+    "usage-group-range": lambda months, rng: "/usage-group?from={}&to={}".format(*month_range(months, rng)),
+    "cube": lambda months, rng: "/cube?from={}&to={}&group_by=store,age_group".format(*month_range(months, rng)),
+}
+
+
+def month_range(months: list, rng: random.Random, length: int = 12) -> tuple:
+    """months から連続する最大 length か月の範囲 (開始, 終了) を選ぶ関数"""
+    start = rng.randrange(max(1, len(months) - length + 1))
+    return months[start], months[min(start + length, len(months)) - 1]
+
+
+def git_commit() -> tuple:
+    """(コミットの短いハッシュ, 未コミットの変更があるか) を返す関数"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    """レイテンシ（秒）の一覧から p50/p95/p99（ミリ秒）とスループットを求める関数"""
+    values = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "mean_ms": round(float(values.mean()), 3),
+        "rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+async def run_endpoint(client, name: str, months: list, requests: int, concurrency: int, seed: int) -> dict:
+    """1つのエンドポイントに concurrency 本の並列で合計 requests 回リクエストし、結果を集計する関数"""
+    rng = random.Random(seed)
+    urls = [ENDPOINTS[name](months, rng) for _ in range(requests)]
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while urls:
+            url = urls.pop()
+            started = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or response.content.startswith(b'{"error"'):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run(args) -> dict:
+    # main_SQL は読み込み時に DB_PATH などの環境変数を読むので、設定してから import する
+    os.environ["DB_PATH"] = os.path.abspath(args.db)
+    if args.no_cache:
+        os.environ["RESPONSE_CACHE_SIZE"] = "0"
+    import httpx
+    import db_SQL
+    import main_SQL
+
+    with sqlite3.connect(f"file:{os.path.abspath(args.db)}?mode=ro", uri=True) as conn:
+        months = [str(row[0]) for row in conn.execute("SELECT year_month FROM monthly_summary ORDER BY year_month")]
+        fact_rows = conn.execute("SELECT COUNT(*) FROM final_combined_data").fetchone()[0]
+    if not months:
+        raise SystemExit(f"{args.db} に集計済みの月がありません（etl_SQL.py を実行してください）")
+
+    names = args.endpoints.split(",") if args.endpoints else list(ENDPOINTS)
+    results = {}
+    transport = httpx.ASGITransport(app=main_SQL.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+        for index, name in enumerate(names):
+            # ウォームアップ（プール接続の作成・メモリ上のスナップショットの作成など）は計測に含めない
+            await run_endpoint(client, name, months, args.warmup, args.concurrency, args.seed + index)
+            results[name] = await run_endpoint(client, name, months, args.requests, args.concurrency, args.seed + index)
+            print(f"{name:<24} p50 {results[name]['p50_ms']:8.2f} ms  p95 {results[name]['p95_ms']:8.2f} ms  "
+                  f"p99 {results[name]['p99_ms']:8.2f} ms  {results[name]['rps']:8.1f} req/s  errors {results[name]['errors']}")
+    db_SQL.shutdown()
+
+    commit, dirty = git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "db": os.path.basename(args.db),
+        "fact_rows": fact_rows,
+        "months": len(months),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "cache": not args.no_cache,
+            "analytics_backend": main_SQL.ANALYTICS_BACKEND,
+            "serving_mode": main_SQL.SERVING_MODE,
+            "pool_size": db_SQL.POOL_SIZE,
+        },
+        "results": results,
+    }
+
+
+def compare(old_path: str, new_path: str, threshold: float) -> bool:
+    """2つの結果ファイルを比較して表示する関数。p95 が threshold（割合）以上悪化したエンドポイントがあれば False"""
+    with open(old_path, "r") as file:
+        old = json.load(file)
+    with open(new_path, "r") as file:
+        new = json.load(file)
+    print(f"{old['commit']} ({old['db']}) -> {new['commit']} ({new['db']})")
+    ok = True
+    for name, after in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            print(f"{name:<24} (比較対象なし)")
+            continue
+        ratio = after["p95_ms"] / before["p95_ms"] if before["p95_ms"] else float("inf")
+        regressed = ratio > 1 + threshold
+        ok = ok and not regressed
+        print(f"{name:<24} p95 {before['p95_ms']:8.2f} -> {after['p95_ms']:8.2f} ms (x{ratio:5.2f})  "
+              f"{before['rps']:8.1f} -> {after['rps']:8.1f} req/s{'  ** 劣化 **' if regressed else ''}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API の負荷試験")
+    parser.add_argument("--db", default=os.path.join(ROOT, "pop-make-up_DB_add.db"), help="試験に使うDB（datagen.py で作成）")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="エンドポイントごとのリクエスト数")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="同時リクエスト数")
+    parser.add_argument("--warmup", type=int, default=20, help="計測前に送るリクエスト数")
+    parser.add_argument("--endpoints", default="", help=f"カンマ区切り（省略時すべて: {','.join(ENDPOINTS)}）")
+    parser.add_argument("--no-cache", action="store_true", help="レスポンスキャッシュを無効にする")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="結果の保存先（省略時 benchmarks/results/{コミット}.json）")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="2つの結果ファイルを比較する")
+    parser.add_argument("--threshold", type=float, default=0.1, help="--compare で劣化とみなす p95 の悪化割合")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(0 if compare(*args.compare, args.threshold) else 1)
+
+    report = asyncio.run(run(args))
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['commit']}{'-dirty' if report['dirty'] else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {out}")
@@ -0,0 +1,76 @@
+# verify_backends.py : 集計バックエンド（sql / numpy / arrow）の結果が同じかを確認するスクリプト
+# DB にある全ての月について API①②③と月の範囲の API のレスポンスを各バックエンドで計算し、sql の結果と比べる。
+# 違いがあればその API と年月を表示して終了コード 1 で終わる。
+#   python benchmarks/verify_backends.py --db benchmarks/data/bench_10x.db --export
+#   python benchmarks/verify_backends.py --backends numpy,arrow
+# arrow は PARQUET_DIR に書き出し済みの Parquet を使う（--export で先に現在の DB から書き出す）
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+async def compute_all(main_SQL, months: list) -> dict:
+    """全ての月と範囲について、現在のバックエンドでレスポンスを計算する関数"""
+    results = {}
+    for year_month in months:
+        results[f"monthly-summary/{year_month}"] = await main_SQL.compute_monthly_summary(year_month)
+        results[f"usage-frequency/{year_month}"] = await main_SQL.compute_usage_frequency(year_month)
+        results[f"usage-group/{year_month}"] = await main_SQL.compute_usage_group(year_month)
+    for start in range(0, len(months), main_SQL.MAX_RANGE_MONTHS):
+        from_month, to_month = months[start], months[min(start + main_SQL.MAX_RANGE_MONTHS, len(months)) - 1]
+        key = f"?from={from_month}&to={to_month}"
+        results[f"monthly-summary{key}"] = await main_SQL.compute_monthly_summary_range(from_month, to_month)
+        results[f"usage-group{key}"] = await main_SQL.compute_usage_group_range(from_month, to_month)
+    return results
+
+
+async def verify(backends: list) -> list:
+    """sql と backends の結果を比べ、違いのあった (バックエンド, API) の一覧を返す関数"""
+    import db_SQL
+    import main_SQL
+
+    months = [str(row["year_month"]) for row in await db_SQL.fetch_all(
+        "SELECT year_month FROM monthly_summary ORDER BY year_month"
+    )]
+    main_SQL.backend = main_SQL.create_backend("sql")
+    expected = await compute_all(main_SQL, months)
+    print(f"sql: {len(expected)} 件（{len(months)} か月）")
+
+    mismatches = []
+    for name in backends:
+        main_SQL.backend = main_SQL.create_backend(name)
+        actual = await compute_all(main_SQL, months)
+        # JSON に変換して比べる（int と numpy の整数、tuple と list などの違いは無視する）
+        different = [
+            key for key in expected
+            if json.dumps(expected[key], ensure_ascii=False) != json.dumps(actual.get(key), ensure_ascii=False)
+        ]
+        print(f"{name}: {'一致' if not different else f'{len(different)} 件の違い'}")
+        mismatches += [(name, key) for key in different]
+    db_SQL.shutdown()
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="集計バックエンドの結果が sql と同じかを確認する")
+    parser.add_argument("--db", help="確認に使うDB（省略時は環境変数 DB_PATH または pop-make-up_DB_add.db）")
+    parser.add_argument("--backends", default="numpy,arrow", help="sql と比べるバックエンド（カンマ区切り）")
+    parser.add_argument("--export", action="store_true", help="先に現在の DB から Parquet を書き出す（arrow 用）")
+    args = parser.parse_args()
+    if args.db:
+        os.environ["DB_PATH"] = args.db
+
+    if args.export:
+        from backend_arrow import export_parquet
+        export_parquet(os.environ.get("DB_PATH", 'pop-make-up_DB_add.db'))
+
+    mismatches = asyncio.run(verify(args.backends.split(",")))
+    for name, key in mismatches[:20]:
+        print(f"  {name}: {key}")
+    sys.exit(1 if mismatches else 0)
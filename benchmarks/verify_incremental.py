@@ -0,0 +1,149 @@
+# verify_incremental.py : 差分更新（python etl_SQL.py）の結果が全件再作成（--full）と同じかを確認するスクリプト
+# DB のコピーに次の変更を順に加えながら差分更新し、最後に同じ元データから全件再作成した結果と比べる。
+#   1. 新しい予約の追加と、まだ存在しない stocks / users を参照する予約の追加（結合できない予約）
+#   2. 参照先の stocks / users を後から追加（前回結合できなかった予約が入ること）
+#   3. stocks / users / employee / reservations の更新・削除
+#   4. 何も変更せずに差分更新（ETL 世代が進まないこと）
+# final_combined_data と集計テーブルに違いがあれば、そのテーブルを表示して終了コード 1 で終わる。
+#   python benchmarks/verify_incremental.py
+#   python benchmarks/verify_incremental.py --db benchmarks/data/bench_10x.db
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from etl_SQL import create_etl_engine, run_full_refresh, run_incremental_refresh  # noqa: E402
+
+# 比べるテーブルと並び順
+COMPARED_TABLES = {
+    "final_combined_data": "RSV_ID",
+    "monthly_summary": "year_month",
+    "user_month_stats": "year_month, user_id",
+    "usage_cube": "year_month, STORE_ID, age_group, Gender",
+}
+# 存在しない ID（後から追加する stocks / users に使う）
+MISSING_STOCK_ID = 999_999
+MISSING_USER_ID = 999_999
+
+
+def copy_database(source: str, destination: str) -> None:
+    """WAL の内容も含めて DB をコピーする関数"""
+    with sqlite3.connect(source) as src, sqlite3.connect(destination) as dst:
+        src.backup(dst)
+
+
+def generation(path: str) -> int:
+    with sqlite3.connect(path) as conn:
+        return int(conn.execute("SELECT value FROM etl_state WHERE key = 'generation'").fetchone()[0])
+
+
+def apply_changes(path: str, step: int) -> None:
+    """step 番目の変更を元データに加える関数"""
+    conn = sqlite3.connect(path)
+    with conn:
+        next_id = conn.execute("SELECT MAX(ID) FROM reservations").fetchone()[0] + 1
+        if step == 1:
+            conn.execute(
+                "INSERT INTO reservations (ID, USER_ID, STOCK_ID, MY_COUPON_ID, RSV_TIME, MET) "
+                "SELECT ID + ?, USER_ID, STOCK_ID, MY_COUPON_ID, RSV_TIME, MET FROM reservations "
+                "ORDER BY ID LIMIT 100", (next_id,),
+            )
+            next_id = conn.execute("SELECT MAX(ID) FROM reservations").fetchone()[0] + 1
+            user_id, stock_id = conn.execute("SELECT USER_ID, STOCK_ID FROM reservations LIMIT 1").fetchone()
+            conn.executemany(
+                "INSERT INTO reservations (ID, USER_ID, STOCK_ID, RSV_TIME, MET) VALUES (?, ?, ?, '2024-01-01 12:00:00', 0)",
+                [(next_id, user_id, MISSING_STOCK_ID), (next_id + 1, MISSING_USER_ID, stock_id)],
+            )
+        elif step == 2:
+            conn.execute(
+                "INSERT INTO stocks (ID, PRD_ID, STORE_ID, DATE_ID, LOT, BEST_BY_DAY, PIECES) "
+                "SELECT ?, PRD_ID, STORE_ID, DATE_ID, LOT, BEST_BY_DAY, PIECES FROM stocks LIMIT 1",
+                (MISSING_STOCK_ID,),
+            )
+            conn.execute(
+                "INSERT INTO users (ID, USER_NAME, EMAIL, PASSWORD, IS_ACTIVE, employee_ID) "
+                "SELECT ?, 'late_user', EMAIL, PASSWORD, IS_ACTIVE, employee_ID FROM users LIMIT 1",
+                (MISSING_USER_ID,),
+            )
+        elif step == 3:
+            stock_ids = [row[0] for row in conn.execute("SELECT ID FROM stocks ORDER BY ID LIMIT 3")]
+            conn.execute("UPDATE stocks SET STORE_ID = (SELECT MAX(ID) FROM stores) WHERE ID = ?", (stock_ids[0],))
+            conn.execute(
+                "UPDATE stocks SET DATE_ID = (SELECT MAX(ID) FROM dates WHERE ID IN (SELECT DATE_ID FROM stocks)) "
+                "WHERE ID = ?", (stock_ids[1],),
+            )
+            conn.execute("DELETE FROM stocks WHERE ID = ?", (stock_ids[2],))
+            employee_id = conn.execute("SELECT employee_ID FROM users ORDER BY ID LIMIT 1").fetchone()[0]
+            conn.execute(
+                "UPDATE employee SET birthday = '1960/1/2', "
+                "Gender = CASE Gender WHEN '男性' THEN '女性' ELSE '男性' END WHERE employee_ID = ?", (employee_id,),
+            )
+            conn.execute(
+                "UPDATE users SET employee_ID = (SELECT MAX(employee_ID) FROM employee) "
+                "WHERE ID = (SELECT MAX(ID) FROM users WHERE ID < ?)", (MISSING_USER_ID,),
+            )
+            conn.execute("DELETE FROM reservations WHERE ID IN (SELECT ID FROM reservations ORDER BY ID LIMIT 5)")
+            conn.execute("UPDATE reservations SET STOCK_ID = ? WHERE ID = (SELECT MAX(ID) FROM reservations)",
+                         (stock_ids[0],))
+    conn.close()
+
+
+def compare(incremental: str, full: str) -> list:
+    """2つの DB の final_combined_data と集計テーブルを比べ、違いのあったテーブル名の一覧を返す関数"""
+    different = []
+    with sqlite3.connect(incremental) as a, sqlite3.connect(full) as b:
+        for table, order in COMPARED_TABLES.items():
+            query = f"SELECT * FROM {table} ORDER BY {order}"
+            if a.execute(query).fetchall() != b.execute(query).fetchall():
+                different.append(table)
+    return different
+
+
+def verify(source: str) -> list:
+    """差分更新と全件再作成を比べ、問題の一覧を返す関数"""
+    problems = []
+    with tempfile.TemporaryDirectory() as workdir:
+        incremental = os.path.join(workdir, "incremental.db")
+        full = os.path.join(workdir, "full.db")
+        copy_database(source, incremental)
+        engine = create_etl_engine(f"sqlite:///{incremental}")
+        run_full_refresh(engine)
+
+        for step in (1, 2, 3):
+            apply_changes(incremental, step)
+            result = run_incremental_refresh(engine)
+            print(f"変更 {step}: {result}")
+            if result["mode"] != "incremental":
+                problems.append(f"変更 {step} の後の更新が差分更新になっていません: {result}")
+
+        before = generation(incremental)
+        result = run_incremental_refresh(engine)
+        print(f"変更なし: {result}")
+        if generation(incremental) != before:
+            problems.append("変更がないのに ETL 世代が進みました")
+
+        copy_database(incremental, full)
+        full_engine = create_etl_engine(f"sqlite:///{full}")
+        run_full_refresh(full_engine)
+        problems += [f"{table} が全件再作成の結果と異なります" for table in compare(incremental, full)]
+        engine.dispose()
+        full_engine.dispose()
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="差分更新の結果が全件再作成と同じかを確認する")
+    parser.add_argument("--db", default=os.environ.get("DB_PATH", os.path.join(ROOT, 'pop-make-up_DB_add.db')),
+                        help="元にするDB（コピーして使うので変更されない）")
+    args = parser.parse_args()
+
+    problems = verify(args.db)
+    for problem in problems:
+        print(f"  {problem}")
+    print("一致" if not problems else f"{len(problems)} 件の問題")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,19 @@
+# bitmap_SQL.py : 利用者の集合を圧縮ビットマップにする関数
+# user_id をビット位置とするビットマップを zlib で圧縮して保存する（usage_cube の users 列）。
+# ETL（etl_SQL.py）が書き込み、API（cube_SQL.py）が読み込むので、どちらの依存関係も持ち込まないよう標準ライブラリだけを使う
+
+import zlib
+from typing import Iterable
+
+
+def encode_bitmap(user_ids: Iterable[int]) -> bytes:
+    """user_id の集合を圧縮ビットマップ(bytes)に変換する関数"""
+    bits = 0
+    for user_id in user_ids:
+        bits |= 1 << int(user_id)
+    return zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+
+
+def decode_bitmap(blob: bytes) -> int:
+    """圧縮ビットマップを整数（ビット集合）に戻す関数"""
+    return int.from_bytes(zlib.decompress(blob), "little")
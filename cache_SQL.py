@@ -0,0 +1,243 @@
+# cache_SQL.py : API レスポンスのキャッシュ
+# (エンドポイント, 年月, ETL世代) をキーに、JSONに変換済みのレスポンス本文(bytes)を LRU + TTL で保持する。
+# ETL（etl_SQL.py）がデータを更新するたびに etl_state の generation が増えるので、古い世代のキャッシュは使われなくなる。
+# 本文のハッシュを強い ETag として返し、If-None-Match が一致すれば 304 を返す。
+# キャッシュにない同じキーへのリクエストが同時に来た場合は、1つだけ計算して結果を共有する（single-flight）
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from db_SQL import fetch_scalar
+from metrics_SQL import phase, record_cache, registry
+
+# キャッシュするレスポンスの最大件数
+CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+# 過去の月はデータが変わらないので長めに、当月以降は短めに保持する（秒）
+PAST_MONTH_TTL = int(os.environ.get("RESPONSE_CACHE_PAST_TTL", "86400"))
+CURRENT_MONTH_TTL = int(os.environ.get("RESPONSE_CACHE_CURRENT_TTL", "60"))
+# ETL世代を DB に問い合わせる間隔（秒）
+GENERATION_CHECK_INTERVAL = float(os.environ.get("GENERATION_CHECK_INTERVAL", "1.0"))
+# JSON への変換方法。json: 標準ライブラリ（FastAPI の既定と同じ） / orjson: orjson で直接バイト列に変換する（要 pip install orjson）
+JSON_ENCODER = os.environ.get("JSON_ENCODER", "json")
+
+if JSON_ENCODER == "orjson":
+    import orjson
+elif JSON_ENCODER != "json":
+    raise ValueError(f"Unknown JSON_ENCODER: {JSON_ENCODER}")
+
+
+def make_etag(body: bytes) -> str:
+    """本文のハッシュから強い ETag を作成する関数"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+class CacheEntry:
+    """変換済みのレスポンス本文と ETag"""
+
+    __slots__ = ("body", "etag", "expires_at")
+
+    def __init__(self, body: bytes, ttl: float):
+        self.body = body
+        self.etag = make_etag(body)
+        self.expires_at = time.monotonic() + ttl
+
+
+class ResponseCache:
+    """LRU + TTL のレスポンスキャッシュ"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: tuple, body: bytes, ttl: float) -> CacheEntry:
+        entry = CacheEntry(body, ttl)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SingleFlight:
+    """
+    同じキーの計算が実行中なら新しく実行せず、その結果を待って共有するもの。
+    計算は Task として実行するので、最初に呼び出したリクエストが切断されても待っている他のリクエストには結果が届く
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        # 実際に計算した回数と、実行中の計算に相乗りした回数
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: tuple, func: Callable[[], Awaitable]):
+        task = self._in_flight.get(key)
+        if task is None:
+            self.executed += 1
+            registry.inc("single_flight_requests_total", {"result": "executed"})
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            registry.inc("single_flight_requests_total", {"result": "coalesced"})
+        return await asyncio.shield(task)
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES)
+single_flight = SingleFlight()
+
+_generation = 0
+_generation_checked_at = float("-inf")
+
+
+async def get_generation() -> int:
+    """ETL世代（etl_state の generation）を取得する関数。問い合わせは GENERATION_CHECK_INTERVAL 秒に1回まで"""
+    global _generation, _generation_checked_at
+    now = time.monotonic()
+    if now - _generation_checked_at >= GENERATION_CHECK_INTERVAL:
+        try:
+            value = await fetch_scalar("SELECT value FROM etl_state WHERE key = 'generation'")
+        except sqlite3.OperationalError:
+            # etl_state がまだない（ETL未実行）の場合は世代0とする
+            value = None
+        _generation = int(value or 0)
+        _generation_checked_at = now
+    return _generation
+
+
+class GenerationCachedValue:
+    """ETL世代ごとに1回だけ作成する値（メモリ内のスナップショットなど）。世代が変わったら loader で作り直す"""
+
+    def __init__(self, loader: Callable[[], Awaitable]):
+        self._loader = loader
+        self._value = None
+        self._generation = None
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        generation = await get_generation()
+        if self._generation != generation:
+            async with self._lock:
+                if self._generation != generation:
+                    self._value = await self._loader()
+                    self._generation = generation
+        return self._value
+
+
+def encode_json(content) -> bytes:
+    """FastAPI の JSONResponse と同じ形式（空白なし・非ASCIIはそのまま）で JSON をバイト列に変換する関数"""
+    if JSON_ENCODER == "orjson":
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+# 指定の年月にデータがない場合のエラーの本文（ライブ配信とスナップショット配信で同じものを返す）
+NO_DATA_ERROR = {"error": "No data found for the specified year_month."}
+
+
+def join_dashboard(monthly_summary: bytes, usage_frequency: bytes, usage_group: bytes) -> bytes:
+    """API①②③の変換済みの本文を連結し、ダッシュボード1画面分の本文にする関数（JSON に戻さずにそのまま連結する）"""
+    return (
+        b'{"monthly_summary":' + monthly_summary
+        + b',"usage_frequency":' + usage_frequency
+        + b',"usage_group":' + usage_group + b'}'
+    )
+
+
+class FastJSONResponse(JSONResponse):
+    """encode_json で変換する JSONResponse（JSON_ENCODER=orjson のときは orjson を使う）"""
+
+    def render(self, content) -> bytes:
+        with phase("encode"):
+            return encode_json(content)
+
+
+def ttl_for(year_month: str) -> float:
+    """年月に応じたキャッシュの保持時間を返す関数"""
+    return PAST_MONTH_TTL if year_month < datetime.now().strftime('%Y%m') else CURRENT_MONTH_TTL
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match ヘッダーが ETag と一致するかを判定する関数"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+async def get_cached_entry(
+    endpoint: str, year_month: str, compute: Callable[..., Awaitable], *args: str
+) -> CacheEntry:
+    """
+    キャッシュがあればその本文を、なければ compute(year_month, *args) の結果を変換・保存して返す関数。
+    args には月の範囲の終わりなど追加の年月を渡す（キーと保持時間の判定にも使う）。
+    compute が bytes を返した場合は変換済みの JSON としてそのまま保存する。
+    同じキーの計算が実行中なら、その結果を待って使う
+    """
+    key = (endpoint, year_month, *args, await get_generation())
+    entry = response_cache.get(key)
+    record_cache("miss" if entry is None else "hit")
+    if entry is None:
+        async def compute_entry() -> CacheEntry:
+            content = await compute(year_month, *args)
+            with phase("encode"):
+                body = content if isinstance(content, bytes) else encode_json(content)
+            return response_cache.put(key, body, ttl_for(max(year_month, *args)))
+
+        entry = await single_flight.do(key, compute_entry)
+    return entry
+
+
+async def cached_json_response(
+    request: Request, endpoint: str, year_month: str, compute: Callable[..., Awaitable], *args: str
+) -> Response:
+    """get_cached_entry の本文を ETag 付きで返す関数。If-None-Match が一致すれば 304 を返す"""
+    entry = await get_cached_entry(endpoint, year_month, compute, *args)
+
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+def cache_stats() -> dict:
+    """レスポンスキャッシュと single-flight の統計を返す関数"""
+    return {
+        "response_cache": {"entries": len(response_cache), "hits": response_cache.hits, "misses": response_cache.misses},
+        "single_flight": {
+            "executed": single_flight.executed,
+            "coalesced": single_flight.coalesced,
+            "in_flight": len(single_flight),
+        },
+    }
@@ -0,0 +1,81 @@
+# cube_SQL.py : 月 × 店舗 × 年代 × 性別 の集計キューブ
+# ETL（etl_SQL.py）が usage_cube テーブルに各セルの利用食数と利用者の集合を保存する。
+# 利用者の集合は user_id をビット位置とするビットマップを zlib で圧縮したもの（bitmap_SQL.py）で、
+# 複数のセル（月の範囲・店舗・年代など）をまとめるときはビットマップの OR を取るだけで
+# 正確なユニーク利用者数が求まる（元の明細を読み直す必要がない）
+
+from typing import Optional
+import db_SQL
+from bitmap_SQL import decode_bitmap
+from cache_SQL import GenerationCachedValue
+
+# キューブの軸（/cube の group_by に指定できる名前）
+CUBE_DIMENSIONS = ("month", "store", "age_group", "gender")
+
+
+def null_last_key(value):
+    """
+    並べ替えのキー。性別・店舗名などの NULL(None) を文字列と比べると TypeError になるので、
+    各値を (None かどうか, 値) にして None を最後に並べる（タプルの各要素にも適用する）
+    """
+    if isinstance(value, tuple):
+        return tuple(null_last_key(item) for item in value)
+    return (value is None, value)
+
+
+class UsageCube:
+    """usage_cube テーブルをメモリに展開したもの"""
+
+    def __init__(self, conn):
+        # 各セル: (月, 店舗ID, 店舗名, 年代, 性別, 利用食数, 利用者ビットマップ)
+        self.cells = [
+            (row[0], row[1], row[2], row[3], row[4], row[5], decode_bitmap(row[6]))
+            for row in conn.execute(
+                "SELECT year_month, STORE_ID, STORE, age_group, Gender, meals, users FROM usage_cube"
+            )
+        ]
+
+    def query(
+        self,
+        from_month: int,
+        to_month: int,
+        group_by: list,
+        store_ids: Optional[list] = None,
+        age_groups: Optional[list] = None,
+        genders: Optional[list] = None,
+    ) -> list:
+        """月の範囲と各軸の絞り込みでセルを選び、group_by の軸ごとに合算する関数"""
+        groups = {}
+        for month, store_id, store, age_group, gender, meals, users in self.cells:
+            if not from_month <= month <= to_month:
+                continue
+            if store_ids and store_id not in store_ids:
+                continue
+            if age_groups and age_group not in age_groups:
+                continue
+            if genders and gender not in genders:
+                continue
+            values = {"month": month, "store": (store_id, store), "age_group": age_group, "gender": gender}
+            key = tuple(values[dimension] for dimension in group_by)
+            total = groups.setdefault(key, [0, 0])
+            total[0] += meals
+            total[1] |= users
+
+        rows = []
+        for key, (meals, users) in sorted(groups.items(), key=lambda item: null_last_key(item[0])):
+            row = {}
+            for dimension, value in zip(group_by, key):
+                if dimension == "store":
+                    row["store_id"], row["store"] = value
+                elif dimension == "month":
+                    # 他のエンドポイントと同じく年月は "YYYYMM" の文字列で返す
+                    row["month"] = str(value)
+                else:
+                    row[dimension] = value
+            row["total_users"] = users.bit_count()
+            row["total_meals"] = meals
+            rows.append(row)
+        return rows
+
+
+cube = GenerationCachedValue(lambda: db_SQL.run_in_pool(UsageCube))
@@ -0,0 +1,154 @@
+# db_SQL.py : API 用の非同期DBアクセス
+# 読み取り専用の SQLite 接続をプールし、接続数と同じ数のワーカースレッドでクエリを実行する。
+# エンドポイントからは await fetch_all / fetch_one / fetch_scalar(...) で呼び出すので、遅いクエリがあってもイベントループは止まらない
+# pandas は使わず、カーソルの行をそのまま辞書（またはレスポンスの形）に変換する
+
+import asyncio
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from metrics_SQL import SQL_VM_STEP_INTERVAL, count_vm_steps, track_query
+
+# DB ファイルのパス（負荷試験などで別のDBを使う場合は環境変数 DB_PATH で指定する）
+DB_PATH = os.environ.get("DB_PATH", 'pop-make-up_DB_add.db')
+# final_combined_data に表示名を付けたビューの名前（etl_SQL.py が作成し、export_SQL.py が読む）
+LABELED_VIEW = "final_combined_data_labeled"
+# 同時に実行できるクエリ数（= 接続数 = ワーカースレッド数）
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+# 読み取り用の接続の設定。DB ファイルを mmap で読む大きさ（バイト）と、接続ごとのページキャッシュの大きさ（KiB）
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+CACHE_SIZE_KIB = int(os.environ.get("DB_CACHE_SIZE_KIB", str(64 * 1024)))
+# 接続ごとに再利用する解析・実行計画済みの文（prepared statement）の数。クエリの文字列が同じなら再解析しない
+STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "256"))
+# ETL のコミット（WAL のチェックポイント）と重なったときに待つ時間（ミリ秒）
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+
+
+class ConnectionPool:
+    """読み取り専用の SQLite 接続を使い回すための接続プール"""
+
+    def __init__(self, db_path: str, size: int):
+        self.db_path = db_path
+        self.size = size
+        self._connections = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        読み取り専用(mode=ro)で新しい接続を作成する。
+        DB は ETL が WAL モードにしているので、ETL の実行中もコミット済みのデータを待たずに読める
+        """
+        conn = sqlite3.connect(
+            f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=1")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if SQL_VM_STEP_INTERVAL:
+            # クエリごとの VM 命令数（走査量の目安）を metrics_SQL で数える
+            conn.set_progress_handler(count_vm_steps, SQL_VM_STEP_INTERVAL)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """空いている接続を取り出す。上限まではその場で作成し、それ以上は返却を待つ"""
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            return self.connect()
+        return self._connections.get()
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """接続をプールに戻す"""
+        self._connections.put(conn)
+
+    def close(self) -> None:
+        """プール内の接続をすべて閉じる"""
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+
+pool = ConnectionPool(DB_PATH, POOL_SIZE)
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="db")
+
+
+async def run_in_pool(func, *args):
+    """
+    プールの接続を1つ借りて func(conn, *args) をワーカースレッドで実行する関数。
+    呼び出し元のコンテキスト（リクエストの計測中の RequestMetrics など）をワーカースレッドに引き継ぐ
+    """
+    def task():
+        conn = pool.acquire()
+        try:
+            return func(conn, *args)
+        finally:
+            pool.release(conn)
+
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, task)
+
+
+## 行の変換（row mapper）
+# mapper には sqlite3.Row（row["列名"] で参照できる）が渡される。省略時は辞書に変換する
+# 値は SQL の文字列に埋め込まず、params（? ならタプル、:name なら辞書）で渡す
+# 実行時間・返した行数は track_query で metrics_SQL に記録する
+def _fetch_all(conn: sqlite3.Connection, query: str, params, mapper: Optional[Callable]) -> list:
+    mapper = mapper or dict
+    with track_query(query) as tracked:
+        rows = [mapper(row) for row in conn.execute(query, params)]
+        tracked.rows = len(rows)
+    return rows
+
+
+def _fetch_one(conn: sqlite3.Connection, query: str, params, mapper: Optional[Callable]) -> Optional[Any]:
+    with track_query(query) as tracked:
+        row = conn.execute(query, params).fetchone()
+        if row is None:
+            return None
+        tracked.rows = 1
+        return (mapper or dict)(row)
+
+
+def _fetch_scalar(conn: sqlite3.Connection, query: str, params) -> Any:
+    with track_query(query) as tracked:
+        row = conn.execute(query, params).fetchone()
+        tracked.rows = 1 if row else 0
+    return row[0] if row else None
+
+
+async def fetch_all(query: str, params=(), mapper: Optional[Callable] = None) -> list:
+    """SQLクエリを実行し、全行を mapper で変換したリストを返す関数"""
+    return await run_in_pool(_fetch_all, query, params, mapper)
+
+
+async def fetch_one(query: str, params=(), mapper: Optional[Callable] = None) -> Optional[Any]:
+    """SQLクエリを実行し、先頭の1行だけを mapper で変換して返す関数。行がなければ None"""
+    return await run_in_pool(_fetch_one, query, params, mapper)
+
+
+async def fetch_scalar(query: str, params=()) -> Any:
+    """SQLクエリを実行し、先頭行の先頭列の値を返す関数。行がなければ None"""
+    return await run_in_pool(_fetch_scalar, query, params)
+
+
+def shutdown() -> None:
+    """アプリ終了時にワーカースレッドと接続を片付ける関数"""
+    executor.shutdown(wait=True)
+    pool.close()
@@ -0,0 +1,658 @@
+# etl_SQL.py : final_combined_data に検索用のキー・インデックスを付与し、API 用の集計テーブルを作成・更新する
+# DBdata_SQL.py（全件再作成）の最後で呼ばれる。
+# 単体で python etl_SQL.py を実行すると、前回処理済みの予約ID以降だけを追加する差分更新を行う
+# DB は WAL モードで使うので、ETL の実行中も API（読み取り専用接続）はコミット済みのデータを読み続けられる。
+# 全件再作成はシャドウテーブル（final_combined_data_new）に作成してから、1つのトランザクションで入れ替える
+#   python etl_SQL.py          : 差分更新（初回や変更ログが使えない場合は全件再作成）
+#   python etl_SQL.py --full   : 全件再作成
+#   --parquet を付けると、更新後に ANALYTICS_BACKEND=arrow 用の Parquet も書き出す（backend_arrow.py、要 pyarrow）
+
+import os
+import sys
+from typing import Optional
+from sqlalchemy import create_engine, event, text
+from bitmap_SQL import encode_bitmap
+from db_SQL import LABELED_VIEW
+
+DB_URL = f"sqlite:///{os.environ.get('DB_PATH', 'pop-make-up_DB_add.db')}"
+# 全件再作成で新しいデータを作成する一時的なテーブル（公開時に final_combined_data と入れ替える）
+FINAL_COMBINED_SHADOW = "final_combined_data_new"
+# API の読み取りと書き込みが重なったときに待つ時間（ミリ秒）
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "30000"))
+
+
+def create_etl_engine(url: str = DB_URL):
+    """
+    ETL 用の engine を作成する関数。接続ごとに WAL モードにし、
+    engine.begin() で DDL（DROP / ALTER など）も含めて1つのトランザクションになるよう BEGIN を明示する
+    （sqlite3 モジュールの既定では DDL の前に BEGIN されず、途中の状態が API から見えてしまうため）
+    """
+    engine = create_engine(url)
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+        dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+        dbapi_connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+
+    @event.listens_for(engine, "begin")
+    def on_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+# 日付キーの計算式（d は FINAL_COMBINED_QUERY で結合する dates の別名）
+# date_key   : 20240105 のような整数の日付キー（final_combined_data は日付を文字列ではなくこの整数で持つ）
+# year_month : 202401 のような整数の年月キー
+# year_week  : 202401 のような整数の ISO 週キー（ISO年×100 + ISO週番号）
+#              その週の木曜日の年と通算日から求める
+DATE_KEY_EXPR = "CAST(strftime('%Y%m%d', d.DATE) AS INTEGER)"
+YEAR_MONTH_EXPR = "CAST(strftime('%Y%m', d.DATE) AS INTEGER)"
+ISO_THURSDAY_EXPR = "date(d.DATE, '-3 days', 'weekday 4')"
+YEAR_WEEK_EXPR = (
+    f"CAST(strftime('%Y', {ISO_THURSDAY_EXPR}) AS INTEGER) * 100"
+    f" + (CAST(strftime('%j', {ISO_THURSDAY_EXPR}) AS INTEGER) - 1) / 7 + 1"
+)
+# date_key（列名 {column}）を 'YYYY-MM-DD' の文字列に戻す式
+DATE_FROM_KEY_EXPR = "printf('%04d-%02d-%02d', {column} / 10000, {column} / 100 % 100, {column} % 100)"
+
+# 年代の区分（年代コード, 表示名）。年代コードは年齢の10の位で、20歳未満は 2（20代）、60歳以上は 6（60代以上）にまとめる
+AGE_GROUPS = [(2, '20代'), (3, '30代'), (4, '40代'), (5, '50代'), (6, '60代以上')]
+MIN_AGE_CODE, MAX_AGE_CODE = AGE_GROUPS[0][0], AGE_GROUPS[-1][0]
+
+# 処理①：ユーザー情報の結合。生年月日と性別コードは社員ごとに1回だけ計算する（MATERIALIZED）。{where} で対象の予約を絞り込む
+# birthday には '1990-01-02' と '1990/1/2' の形式が混在しており、strftime は後者を NULL にするので、
+# '/' を '-' に置き換えてから年・月・日に分け、date_key と同じ 19900102 のような整数（birth_key）にする
+USER_RESERVATION_QUERY = """
+WITH user_birthdays AS MATERIALIZED (
+    SELECT
+        user_id,
+        gender_code,
+        CAST(substr(b, 1, 4) AS INTEGER) * 10000
+            + CAST(substr(b, 6, instr(substr(b, 6), '-') - 1) AS INTEGER) * 100
+            + CAST(substr(b, 6 + instr(substr(b, 6), '-')) AS INTEGER) AS birth_key
+    FROM (
+        SELECT u.id AS user_id, g.gender_code, replace(e.birthday, '/', '-') AS b
+        FROM users u
+        JOIN employee e ON u.employee_ID = e.employee_ID
+        LEFT JOIN genders g ON g.Gender = e.Gender
+    )
+)
+SELECT
+    r.id AS RSV_ID,
+    r.user_id,
+    r.stock_id,
+    b.gender_code,
+    b.birth_key
+FROM reservations r
+JOIN user_birthdays b ON r.user_id = b.user_id
+{where}
+"""
+
+# 処理②：お店情報、STOCK情報との結合。final_combined_data は整数のキーとコードだけを持つ（スター・スキーマの事実テーブル）
+# 店舗名・日付の文字列・曜日・年代と性別の表示名は stores / dates / age_groups / genders にあり、
+# API は集計後の行にだけ表示名を付ける（全列を表示名付きで見る場合は final_combined_data_labeled ビュー）。
+# 年代は利用日の満年齢で決める（今日の日付ではないので、年が変わっても過去の月の集計は変わらない）。
+# 満年齢は (date_key - birth_key) / 10000 の整数除算で、利用日の月日が誕生日の月日より前なら1を引いたのと同じになる
+FINAL_COMBINED_QUERY = """
+SELECT
+    df_1.RSV_ID,
+    df_1.user_id,
+    df_1.stock_id,
+    {date_key} AS date_key,
+    st.STORE_ID,
+    MAX({min_age_code}, MIN({max_age_code}, ({date_key} - df_1.birth_key) / 10000 / 10)) AS age_code,
+    df_1.gender_code,
+    {year_month} AS year_month,
+    {year_week} AS year_week
+FROM
+    ({query_1}) df_1
+JOIN stocks st ON df_1.stock_id = st.ID
+JOIN stores s ON st.STORE_ID = s.ID
+JOIN dates d ON st.DATE_ID = d.ID
+"""
+
+FINAL_COMBINED_COLUMNS = (
+    "RSV_ID, user_id, stock_id, date_key, STORE_ID, age_code, gender_code, year_month, year_week"
+)
+# final_combined_data の作り方の版。列の計算方法を変えたら1つ増やす（etl_state と違う場合、次の差分更新は全件再作成になる）
+#   2: 年代を利用日の年 - 生年から利用日の満年齢に変更
+FINAL_COMBINED_VERSION = 2
+
+# final_combined_data に表示名を付けたビュー（以前の final_combined_data と同じ列。確認用の画面や書き出し用）
+# ビューの名前（LABELED_VIEW）は API 側からも使うので db_SQL.py に置く
+CREATE_LABELED_VIEW = f"""
+CREATE VIEW IF NOT EXISTS {LABELED_VIEW} AS
+SELECT
+    f.RSV_ID,
+    f.user_id,
+    f.stock_id,
+    g.Gender,
+    a.age_group,
+    s.STORE,
+    f.STORE_ID,
+    d.DATE,
+    d.WEEK,
+    f.year_month,
+    f.year_week
+FROM final_combined_data f
+LEFT JOIN genders g ON g.gender_code = f.gender_code
+LEFT JOIN age_groups a ON a.age_code = f.age_code
+LEFT JOIN stores s ON s.ID = f.STORE_ID
+LEFT JOIN dates d ON d.DATE = {DATE_FROM_KEY_EXPR.format(column="f.date_key")}
+"""
+
+
+def build_user_reservation_query(where: str = "") -> str:
+    """処理①のSQLクエリを構築する関数"""
+    return USER_RESERVATION_QUERY.format(where=where)
+
+
+def build_final_combined_query(where: str = "") -> str:
+    """処理②（final_combined_data の中身）のSQLクエリを構築する関数"""
+    return FINAL_COMBINED_QUERY.format(
+        query_1=build_user_reservation_query(where),
+        year_month=YEAR_MONTH_EXPR,
+        year_week=YEAR_WEEK_EXPR,
+        date_key=DATE_KEY_EXPR,
+        min_age_code=MIN_AGE_CODE,
+        max_age_code=MAX_AGE_CODE,
+    )
+
+
+def refresh_age_groups(conn) -> None:
+    """年代コードと表示名の対応表（age_groups）を作成・更新する関数"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS age_groups (
+            age_code INTEGER PRIMARY KEY,
+            age_group TEXT NOT NULL
+        )
+    """))
+    conn.execute(
+        text("INSERT OR REPLACE INTO age_groups (age_code, age_group) VALUES (:age_code, :age_group)"),
+        [{"age_code": code, "age_group": label} for code, label in AGE_GROUPS],
+    )
+
+
+def refresh_genders(conn) -> None:
+    """性別コードと表示名の対応表（genders）を作成し、employee に新しい性別の値があれば追加する関数"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS genders (
+            gender_code INTEGER PRIMARY KEY,
+            Gender TEXT NOT NULL UNIQUE
+        )
+    """))
+    conn.execute(text(
+        "INSERT OR IGNORE INTO genders (Gender) "
+        "SELECT DISTINCT Gender FROM employee WHERE Gender IS NOT NULL ORDER BY Gender"
+    ))
+
+
+def refresh_dimensions(conn) -> None:
+    """final_combined_data の作成前に、年代・性別のコード表を用意する関数"""
+    refresh_age_groups(conn)
+    refresh_genders(conn)
+
+
+# final_combined_data の複合インデックス（year_month 先頭のものは月の範囲検索に使う）
+FINAL_COMBINED_INDEXES = {
+    "idx_fcd_month_user": "(year_month, user_id, year_week)",
+    "idx_fcd_month_store": "(year_month, STORE_ID)",
+    "idx_fcd_month_age": "(year_month, age_code)",
+    "idx_fcd_rsv": "(RSV_ID)",
+}
+
+# 差分更新で予約IDの範囲検索・結合に使う元テーブル側のインデックス
+SOURCE_INDEXES = {
+    "idx_reservations_id": "reservations (ID)",
+    "idx_stocks_id": "stocks (ID)",
+    # stocks / users / employee の変更ログのトリガーで、参照している予約を探す
+    "idx_reservations_stock": "reservations (STOCK_ID)",
+    "idx_reservations_user": "reservations (USER_ID)",
+    "idx_users_employee": "users (employee_ID)",
+    # final_combined_data_labeled ビューで date_key から dates を引く
+    "idx_dates_date": "dates (DATE)",
+}
+
+
+def create_indexes(conn) -> None:
+    """final_combined_data と元テーブルに検索用インデックスを作成する関数"""
+    for name, columns in FINAL_COMBINED_INDEXES.items():
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON final_combined_data {columns}"))
+    for name, table_columns in SOURCE_INDEXES.items():
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table_columns}"))
+    conn.execute(text("ANALYZE"))
+
+
+# 月間サマリーの集計テーブル（1ヶ月 = 1行）
+CREATE_MONTHLY_SUMMARY_TABLE = """
+CREATE TABLE IF NOT EXISTS monthly_summary (
+    year_month INTEGER PRIMARY KEY,      -- 202401
+    Month TEXT NOT NULL,                 -- '2024-01'
+    Total_Users INTEGER NOT NULL,        -- 月のユニーク利用者数
+    Total_Stocks_Used INTEGER NOT NULL   -- 月の総利用食数
+)
+"""
+
+MONTHLY_SUMMARY_SELECT = """
+SELECT
+    year_month,
+    printf('%04d-%02d', year_month / 100, year_month % 100) AS Month,
+    COUNT(DISTINCT user_id) AS Total_Users,
+    COUNT(stock_id) AS Total_Stocks_Used
+FROM final_combined_data
+{where}
+GROUP BY year_month
+"""
+
+
+def refresh_monthly_summary(conn, months: Optional[list] = None) -> None:
+    """月間サマリーの集計テーブルを再計算する関数。monthsを指定した場合はその月(202401 形式)だけ更新する"""
+    if months is None:
+        conn.execute(text("DROP TABLE IF EXISTS monthly_summary"))
+        conn.execute(text(CREATE_MONTHLY_SUMMARY_TABLE))
+        conn.execute(text("INSERT INTO monthly_summary " + MONTHLY_SUMMARY_SELECT.format(where="")))
+        return
+    conn.execute(text(CREATE_MONTHLY_SUMMARY_TABLE))
+    for month in months:
+        conn.execute(text("DELETE FROM monthly_summary WHERE year_month = :month"), {"month": month})
+        conn.execute(
+            text("INSERT INTO monthly_summary " + MONTHLY_SUMMARY_SELECT.format(
+                where="WHERE year_month = :month")),
+            {"month": month},
+        )
+
+
+# ユーザー×月ごとの利用状況テーブル（使用頻度の分類やユーザー別の明細に使う）
+CREATE_USER_MONTH_STATS_TABLE = """
+CREATE TABLE IF NOT EXISTS user_month_stats (
+    year_month INTEGER NOT NULL,     -- 202401
+    user_id INTEGER NOT NULL,
+    weeks_used INTEGER NOT NULL,     -- 月内で利用した週の数（ISO週）
+    total_usage INTEGER NOT NULL,    -- 月内の利用回数
+    first_visit TEXT NOT NULL,       -- 月内の初回利用日
+    last_visit TEXT NOT NULL,        -- 月内の最終利用日
+    PRIMARY KEY (year_month, user_id)
+) WITHOUT ROWID
+"""
+
+USER_MONTH_STATS_SELECT = f"""
+SELECT
+    year_month,
+    user_id,
+    COUNT(DISTINCT year_week) AS weeks_used,
+    COUNT(*) AS total_usage,
+    {DATE_FROM_KEY_EXPR.format(column="MIN(date_key)")} AS first_visit,
+    {DATE_FROM_KEY_EXPR.format(column="MAX(date_key)")} AS last_visit
+FROM final_combined_data
+{{where}}
+GROUP BY year_month, user_id
+"""
+
+
+def refresh_user_month_stats(conn, user_months: Optional[set] = None) -> None:
+    """ユーザー×月の利用状況を再計算する関数。user_monthsに(年月, user_id)の組を指定した場合はその組だけ更新する"""
+    if user_months is None:
+        conn.execute(text("DROP TABLE IF EXISTS user_month_stats"))
+        conn.execute(text(CREATE_USER_MONTH_STATS_TABLE))
+        conn.execute(text("INSERT INTO user_month_stats " + USER_MONTH_STATS_SELECT.format(where="")))
+        return
+    conn.execute(text(CREATE_USER_MONTH_STATS_TABLE))
+    for month, user_id in sorted(user_months):
+        params = {"month": month, "user_id": user_id}
+        conn.execute(
+            text("DELETE FROM user_month_stats WHERE year_month = :month AND user_id = :user_id"), params
+        )
+        conn.execute(
+            text("INSERT INTO user_month_stats " + USER_MONTH_STATS_SELECT.format(
+                where="WHERE year_month = :month AND user_id = :user_id")),
+            params,
+        )
+
+
+# 月 × 店舗 × 年代 × 性別 の集計キューブ（/cube 用）。利用者は圧縮ビットマップで持つ（cube_SQL.py 参照）
+CREATE_USAGE_CUBE_TABLE = """
+CREATE TABLE IF NOT EXISTS usage_cube (
+    year_month INTEGER NOT NULL,
+    STORE_ID INTEGER NOT NULL,
+    STORE TEXT,
+    age_group TEXT NOT NULL,
+    Gender TEXT,
+    meals INTEGER NOT NULL,          -- セルの利用食数
+    users BLOB NOT NULL,             -- セルの利用者（user_id のビットマップを zlib 圧縮）
+    PRIMARY KEY (year_month, STORE_ID, age_group, Gender)
+)
+"""
+
+# 店舗・年代・性別のコードで集計してから、集計後の行にだけ表示名を付ける
+USAGE_CUBE_SELECT = """
+SELECT
+    c.year_month,
+    c.STORE_ID,
+    s.STORE,
+    a.age_group,
+    g.Gender,
+    c.meals,
+    c.user_ids
+FROM (
+    SELECT
+        year_month,
+        STORE_ID,
+        age_code,
+        gender_code,
+        COUNT(stock_id) AS meals,
+        group_concat(DISTINCT user_id) AS user_ids
+    FROM final_combined_data
+    {where}
+    GROUP BY year_month, STORE_ID, age_code, gender_code
+) c
+JOIN stores s ON s.ID = c.STORE_ID
+JOIN age_groups a ON a.age_code = c.age_code
+LEFT JOIN genders g ON g.gender_code = c.gender_code
+"""
+
+
+def refresh_usage_cube(conn, months: Optional[list] = None) -> None:
+    """集計キューブを再計算する関数。monthsを指定した場合はその月(202401 形式)のセルだけ更新する"""
+    if months is None:
+        conn.execute(text("DROP TABLE IF EXISTS usage_cube"))
+        conn.execute(text(CREATE_USAGE_CUBE_TABLE))
+        rows = conn.execute(text(USAGE_CUBE_SELECT.format(where=""))).fetchall()
+    else:
+        conn.execute(text(CREATE_USAGE_CUBE_TABLE))
+        rows = []
+        for month in months:
+            conn.execute(text("DELETE FROM usage_cube WHERE year_month = :month"), {"month": month})
+            rows += conn.execute(
+                text(USAGE_CUBE_SELECT.format(where="WHERE year_month = :month")), {"month": month}
+            ).fetchall()
+    cells = [
+        {
+            "year_month": row.year_month,
+            "STORE_ID": row.STORE_ID,
+            "STORE": row.STORE,
+            "age_group": row.age_group,
+            "Gender": row.Gender,
+            "meals": row.meals,
+            "users": encode_bitmap(int(user_id) for user_id in row.user_ids.split(",")),
+        }
+        for row in rows
+    ]
+    if cells:
+        conn.execute(text("""
+            INSERT INTO usage_cube (year_month, STORE_ID, STORE, age_group, Gender, meals, users)
+            VALUES (:year_month, :STORE_ID, :STORE, :age_group, :Gender, :meals, :users)
+        """), cells)
+
+
+## 差分更新の状態管理
+# etl_state : 最後に処理した reservations.ID / RSV_TIME（ウォーターマーク）、ETL 世代(generation)、final_combined_data の作り方の版
+# reservations_changelog : 再処理する予約IDの一覧。次のものを記録する
+#   - トリガー : 処理済みの予約の更新・削除・ID の若い追加と、stocks / users / employee の更新・削除で結合結果が変わる予約
+#   - pending  : stocks / users / employee の行がまだなく、結合できずに final_combined_data に入らなかった予約
+#                （ウォーターマークより前になっても、次回以降の差分更新で結合し直す）
+# ※ stores / dates の変更は追跡しないので python etl_SQL.py --full で全件再作成する。
+#   トリガーが消えている（テーブルの作り直しなど）場合は、次の差分更新が全件再作成になる
+CREATE_ETL_STATE_TABLE = """
+CREATE TABLE IF NOT EXISTS etl_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)
+"""
+
+CREATE_CHANGELOG_TABLE = """
+CREATE TABLE IF NOT EXISTS reservations_changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    RSV_ID INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+CHANGELOG_TRIGGERS = {
+    "trg_reservations_late_insert": """
+        CREATE TRIGGER IF NOT EXISTS trg_reservations_late_insert AFTER INSERT ON reservations
+        WHEN NEW.ID <= (SELECT CAST(value AS INTEGER) FROM etl_state WHERE key = 'last_rsv_id')
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op) VALUES (NEW.ID, 'insert');
+        END
+    """,
+    "trg_reservations_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_reservations_update AFTER UPDATE ON reservations
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op) VALUES (OLD.ID, 'update');
+            INSERT INTO reservations_changelog (RSV_ID, op) SELECT NEW.ID, 'update' WHERE NEW.ID IS NOT OLD.ID;
+        END
+    """,
+    "trg_reservations_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_reservations_delete AFTER DELETE ON reservations
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op) VALUES (OLD.ID, 'delete');
+        END
+    """,
+    # 結合先の更新・削除：その行を参照している予約を再処理する
+    # （追加は記録しない。結合先より先に入った予約は pending として残っているので、次回結合し直す）
+    "trg_stocks_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_stocks_update AFTER UPDATE ON stocks
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op)
+            SELECT ID, 'stock' FROM reservations WHERE STOCK_ID IN (OLD.ID, NEW.ID);
+        END
+    """,
+    "trg_stocks_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_stocks_delete AFTER DELETE ON stocks
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op)
+            SELECT ID, 'stock' FROM reservations WHERE STOCK_ID = OLD.ID;
+        END
+    """,
+    "trg_users_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_users_update AFTER UPDATE ON users
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op)
+            SELECT ID, 'user' FROM reservations WHERE USER_ID IN (OLD.ID, NEW.ID);
+        END
+    """,
+    "trg_users_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op)
+            SELECT ID, 'user' FROM reservations WHERE USER_ID = OLD.ID;
+        END
+    """,
+    "trg_employee_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_employee_update AFTER UPDATE ON employee
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op)
+            SELECT r.ID, 'employee' FROM reservations r
+            WHERE r.USER_ID IN (SELECT u.ID FROM users u WHERE u.employee_ID IN (OLD.employee_ID, NEW.employee_ID));
+        END
+    """,
+    "trg_employee_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_employee_delete AFTER DELETE ON employee
+        BEGIN
+            INSERT INTO reservations_changelog (RSV_ID, op)
+            SELECT r.ID, 'employee' FROM reservations r
+            WHERE r.USER_ID IN (SELECT u.ID FROM users u WHERE u.employee_ID = OLD.employee_ID);
+        END
+    """,
+}
+
+# reservations のうち、final_combined_data に行がない（結合できなかった）予約を pending として変更ログに残すクエリ
+# {where} で対象の予約を絞り込む
+RECORD_PENDING_QUERY = """
+INSERT INTO reservations_changelog (RSV_ID, op)
+SELECT r.ID, 'pending'
+FROM reservations r
+WHERE {where}
+  AND NOT EXISTS (SELECT 1 FROM final_combined_data f WHERE f.RSV_ID = r.ID)
+"""
+
+
+def get_state(conn, key: str) -> Optional[str]:
+    """etl_state から値を取得する関数"""
+    row = conn.execute(text("SELECT value FROM etl_state WHERE key = :key"), {"key": key}).fetchone()
+    return row[0] if row else None
+
+
+def set_state(conn, key: str, value) -> None:
+    """etl_state に値を保存する関数"""
+    conn.execute(
+        text("INSERT OR REPLACE INTO etl_state (key, value) VALUES (:key, :value)"),
+        {"key": key, "value": None if value is None else str(value)},
+    )
+
+
+def install_change_log(conn) -> None:
+    """差分更新用の状態テーブル・変更ログ・トリガーを作成する関数"""
+    conn.execute(text(CREATE_ETL_STATE_TABLE))
+    conn.execute(text(CREATE_CHANGELOG_TABLE))
+    for trigger in CHANGELOG_TRIGGERS.values():
+        conn.execute(text(trigger))
+
+
+def change_log_is_active(conn) -> bool:
+    """変更ログのトリガーがすべて残っているか（前回の ETL 以降の変更がすべて記録されているか）を確認する関数"""
+    rows = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).fetchall()
+    return set(CHANGELOG_TRIGGERS) <= {row[0] for row in rows}
+
+
+def bump_generation(conn) -> None:
+    """データ更新のたびに ETL 世代（API のレスポンスキャッシュのキー）を1つ進める関数"""
+    generation = int(get_state(conn, "generation") or 0)
+    set_state(conn, "generation", generation + 1)
+
+
+def save_watermark(conn) -> None:
+    """現在の reservations の最大ID・最大RSV_TIMEをウォーターマークとして保存する関数"""
+    last_id, last_time = conn.execute(text("SELECT MAX(ID), MAX(RSV_TIME) FROM reservations")).fetchone()
+    set_state(conn, "last_rsv_id", last_id or 0)
+    set_state(conn, "last_rsv_time", last_time)
+
+
+def refresh_serving_tables(conn) -> None:
+    """final_combined_data の再作成後にインデックス・API 用の集計テーブル・差分更新の状態をまとめて更新する関数"""
+    create_indexes(conn)
+    refresh_dimensions(conn)
+    conn.execute(text(CREATE_LABELED_VIEW))
+    refresh_monthly_summary(conn)
+    refresh_user_month_stats(conn)
+    refresh_usage_cube(conn)
+    install_change_log(conn)
+    conn.execute(text("DELETE FROM reservations_changelog"))
+    conn.execute(text(RECORD_PENDING_QUERY.format(where="1")))
+    save_watermark(conn)
+    set_state(conn, "final_combined_version", FINAL_COMBINED_VERSION)
+    bump_generation(conn)
+
+
+def publish_final_combined(engine) -> None:
+    """
+    シャドウテーブル（FINAL_COMBINED_SHADOW）を final_combined_data と入れ替え、
+    インデックス・集計テーブルなども同じトランザクションで作り直す関数。
+    API はコミットまで旧データを、コミット後は新しいデータだけを読む（作成途中の状態は見えない）
+    """
+    with engine.begin() as conn:
+        # ビューが参照しているテーブルは入れ替えられないので、ビューは作り直す
+        conn.execute(text(f"DROP VIEW IF EXISTS {LABELED_VIEW}"))
+        conn.execute(text("DROP TABLE IF EXISTS final_combined_data"))
+        conn.execute(text(f"ALTER TABLE {FINAL_COMBINED_SHADOW} RENAME TO final_combined_data"))
+        refresh_serving_tables(conn)
+
+
+def run_full_refresh(engine) -> None:
+    """final_combined_data を SQL だけで全件再作成する関数（DBdata_SQL.py の pandas 版と同じ内容）"""
+    with engine.begin() as conn:
+        refresh_dimensions(conn)
+        conn.execute(text(f"DROP TABLE IF EXISTS {FINAL_COMBINED_SHADOW}"))
+        conn.execute(text(f"CREATE TABLE {FINAL_COMBINED_SHADOW} AS " + build_final_combined_query()))
+    publish_final_combined(engine)
+
+
+def run_incremental_refresh(engine) -> dict:
+    """ウォーターマーク以降の新しい予約と、変更ログに記録された予約だけを final_combined_data に反映する関数"""
+    with engine.begin() as conn:
+        # トリガーの確認は作成前に行う（消えていた間の変更は記録されていないので全件再作成する）
+        change_log_active = change_log_is_active(conn)
+        install_change_log(conn)
+        # 新しい社員の性別の値があればコードを割り当てておく
+        refresh_dimensions(conn)
+        last_rsv_id = get_state(conn, "last_rsv_id")
+        # final_combined_data がない、列が古い（STORE / DATE などの文字列を持つ旧形式など）、
+        # または作り方の版が古い場合は全件再作成する
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(final_combined_data)"))}
+        has_current_table = (
+            {column.strip() for column in FINAL_COMBINED_COLUMNS.split(",")} <= columns
+            and get_state(conn, "final_combined_version") == str(FINAL_COMBINED_VERSION)
+        )
+        if last_rsv_id is None or not has_current_table or not change_log_active:
+            needs_full_refresh = True
+        else:
+            needs_full_refresh = False
+            last_rsv_id = int(last_rsv_id)
+
+            # 今回処理する変更ログの範囲を確定し、対象の予約IDを一時テーブルに集める
+            max_seq = conn.execute(text("SELECT MAX(seq) FROM reservations_changelog")).scalar() or 0
+            conn.execute(text("DROP TABLE IF EXISTS temp.etl_changed"))
+            conn.execute(text(
+                "CREATE TEMP TABLE etl_changed AS "
+                "SELECT DISTINCT RSV_ID FROM reservations_changelog WHERE seq <= :max_seq"
+            ), {"max_seq": max_seq})
+
+            # 変更された予約の旧データを削除（集計し直すユーザー×月を控えておく）
+            affected_user_months = {tuple(row) for row in conn.execute(text(
+                "SELECT DISTINCT year_month, user_id FROM final_combined_data "
+                "WHERE RSV_ID IN (SELECT RSV_ID FROM temp.etl_changed)"
+            ))}
+            deleted = conn.execute(text(
+                "DELETE FROM final_combined_data WHERE RSV_ID IN (SELECT RSV_ID FROM temp.etl_changed)"
+            )).rowcount
+
+            # 新しい予約と変更された予約だけを結合して追加
+            inserted = conn.execute(
+                text(f"INSERT INTO final_combined_data ({FINAL_COMBINED_COLUMNS}) " + build_final_combined_query(
+                    "WHERE r.ID > :last_rsv_id OR r.ID IN (SELECT RSV_ID FROM temp.etl_changed)")),
+                {"last_rsv_id": last_rsv_id},
+            ).rowcount
+            affected_user_months |= {tuple(row) for row in conn.execute(text(
+                "SELECT DISTINCT year_month, user_id FROM final_combined_data "
+                "WHERE RSV_ID > :last_rsv_id OR RSV_ID IN (SELECT RSV_ID FROM temp.etl_changed)"
+            ), {"last_rsv_id": last_rsv_id})}
+            affected_months = {month for month, _ in affected_user_months}
+
+            refresh_monthly_summary(conn, sorted(affected_months))
+            refresh_user_month_stats(conn, affected_user_months)
+            refresh_usage_cube(conn, sorted(affected_months))
+            conn.execute(text("DELETE FROM reservations_changelog WHERE seq <= :max_seq"), {"max_seq": max_seq})
+            # 今回も結合できなかった予約は、ウォーターマークを進めた後も次回結合し直せるよう pending として残す
+            conn.execute(
+                text(RECORD_PENDING_QUERY.format(
+                    where="(r.ID > :last_rsv_id OR r.ID IN (SELECT RSV_ID FROM temp.etl_changed))")),
+                {"last_rsv_id": last_rsv_id},
+            )
+            conn.execute(text("DROP TABLE temp.etl_changed"))
+            save_watermark(conn)
+            # pending の予約を結合し直しただけで何も変わらなかった場合は、世代を進めない（キャッシュを保つ）
+            if deleted or inserted:
+                bump_generation(conn)
+
+    if needs_full_refresh:
+        run_full_refresh(engine)
+        return {"mode": "full"}
+    return {"mode": "incremental", "inserted": inserted, "months": sorted(affected_months)}
+
+
+if __name__ == "__main__":
+    engine = create_etl_engine(DB_URL)
+    if "--full" in sys.argv[1:]:
+        run_full_refresh(engine)
+        print("final_combined_data を全件再作成しました。")
+    else:
+        result = run_incremental_refresh(engine)
+        print(f"final_combined_data を更新しました: {result}")
+    if "--parquet" in sys.argv[1:]:
+        from backend_arrow import PARQUET_DIR, export_parquet
+        manifest = export_parquet(engine.url.database)
+        print(f"{PARQUET_DIR}/{manifest['path']} に Parquet を書き出しました。")
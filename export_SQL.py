@@ -0,0 +1,115 @@
+# export_SQL.py : 1か月分の明細（final_combined_data_labeled）を CSV / NDJSON で少しずつ返す書き出し
+# main_SQL.py の /export/{year_month} で使う。
+# 行は専用の読み取り接続のカーソルから EXPORT_CHUNK_ROWS 行ずつ取り出し、変換（と gzip 圧縮）したものから順に送る。
+# 一度にメモリに持つのは1チャンク分だけなので、月のデータ量に関係なくメモリ使用量は一定になる。
+# 書き出しはワーカースレッドで実行し、接続もプール（API の集計用）とは別に作るので、長い書き出しの間も他の API は待たされない
+
+import csv
+import io
+import json
+import os
+import threading
+import zlib
+from typing import Iterator
+import db_SQL
+from db_SQL import LABELED_VIEW
+from metrics_SQL import track_query
+
+# 一度にカーソルから取り出して変換する行数
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "1000"))
+# 同時に実行できる書き出しの数（それ以上は 429 を返す）
+EXPORT_MAX_CONCURRENCY = int(os.environ.get("EXPORT_MAX_CONCURRENCY", "2"))
+# 同時実行数の上限に達したときに 429 の Retry-After で返す、再試行までの秒数
+EXPORT_RETRY_AFTER = int(os.environ.get("EXPORT_RETRY_AFTER", "10"))
+# gzip の圧縮レベル（1: 速い 〜 9: 小さい）
+EXPORT_GZIP_LEVEL = int(os.environ.get("EXPORT_GZIP_LEVEL", "6"))
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+# インデックス(year_month 先頭)の順に読む。並べ替え（ORDER BY）はしない（一時的な並べ替え用の領域を使わないため）
+EXPORT_QUERY = f"SELECT * FROM {LABELED_VIEW} WHERE year_month = ?"
+
+_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENCY)
+
+
+def acquire_slot() -> bool:
+    """書き出しの枠を1つ確保する関数。上限に達していれば False"""
+    return _slots.acquire(blocking=False)
+
+
+def encode_chunks(cursor, export_format: str) -> Iterator[tuple]:
+    """カーソルの行を EXPORT_CHUNK_ROWS 行ずつ CSV / NDJSON の文字列に変換し、(文字列, 行数) を返すジェネレーター"""
+    columns = [column[0] for column in cursor.description]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if export_format == "csv":
+        writer.writerow(columns)
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            break
+        if export_format == "csv":
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                buffer.write("\n")
+        yield buffer.getvalue(), len(rows)
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # 行のない月の CSV はヘッダー行だけを返す
+        yield buffer.getvalue(), 0
+
+
+class ExportStream:
+    """
+    1か月分の明細を bytes のチャンクで返すイテレーター（StreamingResponse がワーカースレッドで順に読む）。
+    作成前に acquire_slot() で確保した枠は、最後まで送った・途中で切断された・送る前に破棄されたのいずれでも返す
+    """
+
+    def __init__(self, year_month_key: int, export_format: str, compress: bool):
+        self._chunks = self._generate(year_month_key, export_format, compress)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._chunks.close()
+            _slots.release()
+
+    def __del__(self):
+        self.close()
+
+    @staticmethod
+    def _generate(year_month_key: int, export_format: str, compress: bool) -> Iterator[bytes]:
+        # 接続は最初のチャンクを読むとき（ワーカースレッド）に作り、終わったら閉じる
+        conn = db_SQL.pool.connect()
+        try:
+            compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+            with track_query(EXPORT_QUERY) as tracked:
+                cursor = conn.execute(EXPORT_QUERY, (year_month_key,))
+                for text, rows in encode_chunks(cursor, export_format):
+                    tracked.rows += rows
+                    data = text.encode("utf-8")
+                    if compressor is not None:
+                        data = compressor.compress(data)
+                    if data:
+                        yield data
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            conn.close()
@@ -2,14 +2,43 @@
 # uvicorn main:app --reload で起動
 # http://127.0.0.1:8000/docs で仕様確認
 # 年月をstr 数値6桁で GET送信, 各レスポンスが返ってくるアプリ
-
-import json
-import pandas as pd
-from sqlalchemy import create_engine
-from typing import Optional
-from fastapi import FastAPI
+# 事前に DBdata_SQL.py（または python etl_SQL.py）で集計テーブルを作成しておくこと
+
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated, Callable, Literal, Optional
+from fastapi import FastAPI, Path, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from datetime import datetime, timedelta
+import db_SQL
+from db_SQL import fetch_all, fetch_one, fetch_scalar
+from cache_SQL import (
+    NO_DATA_ERROR, FastJSONResponse, cache_stats, cached_json_response, get_cached_entry, join_dashboard,
+    response_cache,
+)
+import metrics_SQL
+from metrics_SQL import phase
+from snapshot_SQL import SNAPSHOT_PATH, SnapshotStore, snapshot_response
+import cube_SQL
+import export_SQL
+
+# 配信モード。live: DB から計算して返す（レスポンスキャッシュあり）
+#           snapshot: snapshot_SQL.py で作成したファイルの変換済みの本文をそのまま返す（API①②③とダッシュボード）
+SERVING_MODE = os.environ.get("SERVING_MODE", "live")
+
+# 集計に使うバックエンド。sql: SQLite に直接問い合わせる / numpy: 列指向のメモリ内スナップショットで集計する
+#                       arrow: ETL が書き出した月ごとの Parquet ファイルを pyarrow で集計する（backend_arrow.py。Parquet の世代が DB と違う間は sql で集計する）
+ANALYTICS_BACKEND = os.environ.get("ANALYTICS_BACKEND", "sql")
+
+# パス・クエリの年月（YYYYMM 形式、月は01〜12）。形式が違う場合は 422 を返す
+YEAR_MONTH_PATTERN = r"^\d{4}(0[1-9]|1[0-2])$"
+YearMonth = Annotated[str, Path(pattern=YEAR_MONTH_PATTERN)]
+FromMonth = Annotated[str, Query(alias="from", pattern=YEAR_MONTH_PATTERN)]
+ToMonth = Annotated[str, Query(alias="to", pattern=YEAR_MONTH_PATTERN)]
 
 # CORSを許可するオリジンのリスト
 origins = [
@@ -17,8 +46,15 @@ origins = [
     "https://api.example.com"
 ]
 
-app = FastAPI()
-engine = create_engine("sqlite:///pop-make-up_DB_add.db")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # 終了時にDB接続プールを閉じる
+    db_SQL.shutdown()
+
+
+# キャッシュを通らないレスポンス（/cube やエラーなど）も encode_json で変換する
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # CORSミドルウェアの設定
 app.add_middleware(
@@ -29,56 +65,81 @@ app.add_middleware(
     allow_headers=["*"],  # または特定のヘッダー ['X-Custom-Header']
 )
 
-# データフレームの辞書化
-def execute_query(query: str) -> Optional[dict]:
-    """SQLクエリを実行し、結果を辞書形式で返す関数"""
-    df = pd.read_sql_query(query, engine)
-    if df.empty:
-        return None
-    return df.to_dict(orient='records')
+
+# 集計テーブル（monthly_summary など）や列がまだない DB（ETL 未実行）の場合は、500 ではなく対処方法を返す
+@app.exception_handler(sqlite3.OperationalError)
+async def handle_missing_schema(request: Request, exc: sqlite3.OperationalError):
+    message = str(exc)
+    if not message.startswith(("no such table", "no such column")):
+        raise exc
+    return FastJSONResponse(
+        {"error": f"The database has not been prepared for the API ({message}). Run `python etl_SQL.py` first."},
+        status_code=503,
+    )
 
 
+# リクエストごとの計測（処理段階ごとの時間・SQL・キャッシュ）。結果は /metrics で確認できる
+# PROFILING_ENABLED=1 のときは ?profile=1 で、本来のレスポンスの代わりに計測結果と呼び出しツリーを返す
+@app.middleware("http")
+async def collect_metrics(request: Request, call_next):
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    sampler = None
+    if metrics_SQL.PROFILING_ENABLED and request.query_params.get("profile") == "1":
+        sampler = metrics_SQL.start_profiler()
+    metrics, token = metrics_SQL.start_request()
+    started = time.perf_counter()
+    response = None
+    try:
+        response = await call_next(request)
+    finally:
+        seconds = time.perf_counter() - started
+        status = response.status_code if response is not None else 500
+        # エンドポイントはパスそのものではなくルートの定義（/usage-group/{year_month} など）で集計する
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        metrics_SQL.finish_request(metrics, token, endpoint, status, seconds)
+        if sampler is not None and response is None:
+            sampler.stop()
+    if sampler is not None:
+        return FastJSONResponse(metrics_SQL.profile_report(metrics, sampler, endpoint, status, seconds))
+    return response
+
+def to_year_month_key(year_month: str) -> int:
+    """'YYYYMM'形式の年月を final_combined_data の整数キー(year_month)に変換する関数"""
+    return int(f"{year_month[:4]}{year_month[4:6]}")
+
 
 ## API①
-def build_monthly_summary_query(formatted_year_month: str) -> str:
-    """月間サマリーのSQLクエリを構築する関数"""
-    return f"""
+# 月間サマリーのSQLクエリ。ETLで集計済みの monthly_summary から1行だけ読む
+MONTHLY_SUMMARY_QUERY = """
     SELECT
-        strftime('%Y-%m', DATE) AS Month,
-        COUNT(DISTINCT user_id) AS Total_Users,
-        COUNT(stock_id) AS Total_Stocks_Used
-    FROM final_combined_data
-    WHERE strftime('%Y-%m', DATE) = '{formatted_year_month}'
-    GROUP BY strftime('%Y-%m', DATE)
-    """
+        Month,
+        Total_Users,
+        Total_Stocks_Used
+    FROM monthly_summary
+    WHERE year_month = :year_month
+"""
 
 ## API②
-def get_total_users_count() -> int:
-    """ユーザーの総数を取得する関数"""
-    query = "SELECT COUNT(*) AS TotalUserCount FROM users"
-    result = execute_query(query)
-    if result:
-        return result[0]['TotalUserCount']
-    else:
-        return 0
-
-def build_usage_frequency_query(formatted_year_month: str) -> str:
-    """使用頻度に関するSQLクエリを構築する関数。週利用回数が0のユーザー数も正確に計算する。"""
-    total_users_count = get_total_users_count()  # ユーザー総数を取得
-    return f"""
+# 使用頻度に関するSQLクエリ。週利用回数が0のユーザー数も正確に計算する。
+# 当月と前月のカテゴリ別ユーザー数を1回のクエリでまとめて返す（year_month 列で月を区別）。
+# ユーザー総数もクエリ内で数えるので、別途問い合わせる必要はない。
+# 週ごとの利用状況は ETL で集計済みの user_month_stats（ユーザー×月で1行）から読む。
+USAGE_FREQUENCY_QUERY = """
     WITH UserWeeklyUsage AS (
         SELECT
+            year_month,
             user_id,
-            COUNT(DISTINCT strftime('%W', DATE)) AS WeeksUsed,
-            COUNT(*) AS TotalUsage
+            weeks_used AS WeeksUsed,
+            total_usage AS TotalUsage
         FROM
-            final_combined_data
+            user_month_stats
         WHERE
-            strftime('%Y-%m', DATE) = '{formatted_year_month}'
-        GROUP BY
-            user_id
+            year_month IN (:year_month, :prev_year_month)
     ), UsageCategory AS (
         SELECT
+            year_month,
             user_id,
             CASE
                 WHEN WeeksUsed = 0 THEN 'zero'
@@ -92,23 +153,31 @@ def build_usage_frequency_query(formatted_year_month: str) -> str:
             UserWeeklyUsage
     ), CategoryCounts AS (
         SELECT
+            year_month,
             Category,
             COUNT(*) AS UsersCount
         FROM
             UsageCategory
         GROUP BY
-            Category
+            year_month, Category
+    ), TargetMonths(year_month) AS (
+        VALUES (:year_month), (:prev_year_month)
     )
     SELECT
+        year_month,
         Category AS UsageCategory,
         UsersCount
     FROM
         CategoryCounts
     UNION ALL
     SELECT
+        m.year_month,
         'zero' AS UsageCategory,
-        {total_users_count} - (SELECT SUM(UsersCount) FROM CategoryCounts) AS UsersCount
-    """
+        (SELECT COUNT(*) FROM users)
+            - (SELECT SUM(c.UsersCount) FROM CategoryCounts c WHERE c.year_month = m.year_month) AS UsersCount
+    FROM
+        TargetMonths m
+"""
 
 def get_previous_month(year_month: str) -> str:
     """指定された年月の前月を計算する"""
@@ -116,6 +185,21 @@ def get_previous_month(year_month: str) -> str:
     previous_month_date = datetime(year, month, 1) - timedelta(days=1)
     return previous_month_date.strftime('%Y%m')
 
+def get_next_month(year_month: str) -> str:
+    """指定された年月の翌月を計算する"""
+    year, month = int(year_month[:4]), int(year_month[4:6])
+    next_month_date = datetime(year, month, 28) + timedelta(days=4)
+    return next_month_date.strftime('%Y%m')
+
+def list_months(from_month: str, to_month: str) -> list:
+    """from_month から to_month まで（両端を含む）の年月のリストを返す関数"""
+    months = []
+    year_month = from_month
+    while year_month <= to_month:
+        months.append(year_month)
+        year_month = get_next_month(year_month)
+    return months
+
 
 
 def calculate_growth_rate(current_count: int, previous_count: Optional[int]) -> float:
@@ -129,8 +213,24 @@ def calculate_growth_rate(current_count: int, previous_count: Optional[int]) ->
     return growth_rate
 
 
+def calculate_growth_series(values: list) -> list:
+    """
+    月ごとの値のリストから前月比の成長率のリストを計算する関数（calculate_growth_rate と同じ規則）。
+    values の先頭は範囲の前月の値で、戻り値は2番目以降の各月に対応する。当月のデータがない月は None。
+    """
+    growth_rates = []
+    for previous_count, current_count in zip(values, values[1:]):
+        if current_count is None:
+            growth_rates.append(None)
+            continue
+        growth_rate = calculate_growth_rate(current_count, previous_count)
+        growth_rates.append(round(growth_rate, 1) if isinstance(growth_rate, float) else growth_rate)
+    return growth_rates
+
+
 def format_usage_frequency_result(year_month: str, current_result: list, previous_result: list) -> dict:
-    # 先月のデータをカテゴリごとにマッピング
+    # 当月・先月のデータをカテゴリごとにマッピング
+    current_data_map = {item['UsageCategory']: item for item in current_result}
     previous_data_map = {item['UsageCategory']: item for item in previous_result}
 
     # カテゴリのリスト
@@ -143,7 +243,7 @@ def format_usage_frequency_result(year_month: str, current_result: list, previou
     formatted_data = {"freq": {}}
 
     for category in categories:
-        current_item = next((item for item in current_result if item['UsageCategory'] == category), None)
+        current_item = current_data_map.get(category, None)
         previous_item = previous_data_map.get(category, None)
 
         current_count = current_item['UsersCount'] if current_item and current_item['UsersCount'] is not None else 0
@@ -173,39 +273,206 @@ def format_usage_frequency_result(year_month: str, current_result: list, previou
 
 
 ## API③
-def build_age_group_query(formatted_year_month: str) -> str:
-    """年齢グループのSQLクエリを構築する関数"""
-    return f"""
+# 年齢グループのSQLクエリ。年代コードで集計してから、集計後の行にだけ年代の表示名（age_groups）を付ける
+AGE_GROUP_QUERY = """
     SELECT
-        strftime('%Y-%m', DATE) AS Month,
-        age_group,
-        COUNT(DISTINCT user_id) AS Users_Per_Age_Group,
-        COUNT(stock_id) AS Stocks_Used_Per_Age_Group
-    FROM
-        final_combined_data
-    WHERE
-        strftime('%Y-%m', DATE) = '{formatted_year_month}'
-    GROUP BY
-        strftime('%Y-%m', DATE), age_group
-    """
+        g.Month,
+        a.age_group,
+        g.Users_Per_Age_Group,
+        g.Stocks_Used_Per_Age_Group
+    FROM (
+        SELECT
+            year_month AS Month,
+            age_code,
+            COUNT(DISTINCT user_id) AS Users_Per_Age_Group,
+            COUNT(stock_id) AS Stocks_Used_Per_Age_Group
+        FROM
+            final_combined_data
+        WHERE
+            year_month = :year_month
+        GROUP BY
+            year_month, age_code
+    ) g
+    JOIN age_groups a ON a.age_code = g.age_code
+    ORDER BY
+        g.age_code
+"""
+
+# 店舗サマリーのSQLクエリ。(year_month, STORE_ID)のインデックスで集計し、集計後の行にだけ店舗名を付けて店舗名順に並べる
+STORE_SUMMARY_QUERY = """
+    SELECT
+        g.Month,
+        s.STORE,
+        g.STORE_ID,
+        g.Users_Per_Store,
+        g.Stocks_Used_Per_Store
+    FROM (
+        SELECT
+            year_month AS Month,
+            STORE_ID,
+            COUNT(DISTINCT user_id) AS Users_Per_Store,
+            COUNT(stock_id) AS Stocks_Used_Per_Store
+        FROM
+            final_combined_data
+        WHERE
+            year_month = :year_month
+        GROUP BY
+            year_month, STORE_ID
+    ) g
+    JOIN stores s ON s.ID = g.STORE_ID
+    ORDER BY
+        s.STORE
+"""
+
+# 書き出し（/export）の前に、その月のデータがあるかを月間サマリーの主キーで確認するクエリ
+EXPORT_MONTH_EXISTS_QUERY = "SELECT 1 FROM monthly_summary WHERE year_month = :year_month"
+
+## 月の範囲（時系列）用のクエリ。範囲内の全月を1回の GROUP BY でまとめて集計する
+# 月間サマリーの範囲クエリ。monthly_summary を主キーの範囲で読む
+MONTHLY_SUMMARY_RANGE_QUERY = """
+    SELECT
+        year_month,
+        Total_Users,
+        Total_Stocks_Used
+    FROM monthly_summary
+    WHERE year_month BETWEEN :from_month AND :to_month
+    ORDER BY year_month
+"""
+
+# 店舗サマリーの範囲クエリ
+STORE_SUMMARY_RANGE_QUERY = """
+    SELECT
+        g.year_month,
+        s.STORE,
+        g.STORE_ID,
+        g.Users_Per_Store,
+        g.Stocks_Used_Per_Store
+    FROM (
+        SELECT
+            year_month,
+            STORE_ID,
+            COUNT(DISTINCT user_id) AS Users_Per_Store,
+            COUNT(stock_id) AS Stocks_Used_Per_Store
+        FROM
+            final_combined_data
+        WHERE
+            year_month BETWEEN :from_month AND :to_month
+        GROUP BY
+            year_month, STORE_ID
+    ) g
+    JOIN stores s ON s.ID = g.STORE_ID
+"""
 
-def build_store_summary_query(formatted_year_month: str) -> str:
-    """店舗サマリーのSQLクエリを構築する関数"""
-    return f"""
+# 年齢グループの範囲クエリ
+AGE_GROUP_RANGE_QUERY = """
     SELECT
-        strftime('%Y-%m', DATE) AS Month,
-        STORE,
-        STORE_ID,
-        COUNT(DISTINCT user_id) AS Users_Per_Store,
-        COUNT(stock_id) AS Stocks_Used_Per_Store
-    FROM
-        final_combined_data
-    WHERE
-        strftime('%Y-%m', DATE) = '{formatted_year_month}'
-    GROUP BY
-        strftime('%Y-%m', DATE), STORE
+        g.year_month,
+        a.age_group,
+        g.Users_Per_Age_Group,
+        g.Stocks_Used_Per_Age_Group
+    FROM (
+        SELECT
+            year_month,
+            age_code,
+            COUNT(DISTINCT user_id) AS Users_Per_Age_Group,
+            COUNT(stock_id) AS Stocks_Used_Per_Age_Group
+        FROM
+            final_combined_data
+        WHERE
+            year_month BETWEEN :from_month AND :to_month
+        GROUP BY
+            year_month, age_code
+    ) g
+    JOIN age_groups a ON a.age_code = g.age_code
+    ORDER BY
+        g.year_month, g.age_code
+"""
+
+def format_store_row(item) -> dict:
+    """店舗サマリーの1行を group_data.json の store_data の形式に変換する関数"""
+    return {
+        "store_id": item["STORE_ID"],
+        "store": item["STORE"],
+        "total_users": item["Users_Per_Store"],
+        "total_meals": item["Stocks_Used_Per_Store"]
+    }
+
+def format_age_group_row(item) -> dict:
+    """年齢グループの1行を group_data.json の age_group_data の形式に変換する関数"""
+    return {
+        "age_group": item["age_group"],
+        "total_users": item["Users_Per_Age_Group"],
+        "total_meals": item["Stocks_Used_Per_Age_Group"]
+    }
+
+def format_monthly_summary_row(item) -> dict:
+    """月間サマリーの1行を dummy_data.json と同じ形式に変換する関数"""
+    return {
+        "total_users": item['Total_Users'],
+        "total_meals": item['Total_Stocks_Used']
+    }
+
+
+## 集計バックエンド
+# どのバックエンドも同じ列名の行を返す。mapper を渡すと各行をそのままレスポンスの形に変換する
+class SQLBackend:
     """
+    SQLite に *_QUERY のクエリを投げて集計するバックエンド。
+    クエリの文字列は固定で年月はパラメータで渡すので、接続ごとの文のキャッシュで解析・実行計画を使い回せる
+    """
+
+    async def monthly_summary(self, year_month_key: int, mapper) -> Optional[dict]:
+        return await fetch_one(MONTHLY_SUMMARY_QUERY, {"year_month": year_month_key}, mapper)
+
+    async def usage_frequency(self, year_month_key: int, prev_year_month_key: int) -> list:
+        return await fetch_all(
+            USAGE_FREQUENCY_QUERY, {"year_month": year_month_key, "prev_year_month": prev_year_month_key}
+        )
+
+    async def store_summary(self, year_month_key: int, mapper) -> list:
+        return await fetch_all(STORE_SUMMARY_QUERY, {"year_month": year_month_key}, mapper)
+
+    async def age_groups(self, year_month_key: int, mapper) -> list:
+        return await fetch_all(AGE_GROUP_QUERY, {"year_month": year_month_key}, mapper)
+
+    async def monthly_summary_range(self, from_key: int, to_key: int) -> list:
+        return await fetch_all(MONTHLY_SUMMARY_RANGE_QUERY, {"from_month": from_key, "to_month": to_key})
+
+    async def store_summary_range(self, from_key: int, to_key: int) -> list:
+        return await fetch_all(STORE_SUMMARY_RANGE_QUERY, {"from_month": from_key, "to_month": to_key})
+
+    async def age_groups_range(self, from_key: int, to_key: int) -> list:
+        return await fetch_all(AGE_GROUP_RANGE_QUERY, {"from_month": from_key, "to_month": to_key})
+
 
+async def handle_backend_not_ready(request: Request, exc: Exception):
+    """集計バックエンドのデータ（Parquet など）がまだ用意されていない場合に 503 を返す"""
+    return FastJSONResponse({"error": str(exc)}, status_code=503)
+
+
+def create_backend(name: str):
+    """名前から集計バックエンドを作成する関数"""
+    if name == "sql":
+        return SQLBackend()
+    if name == "numpy":
+        from backend_numpy import NumpyBackend
+        return NumpyBackend()
+    if name == "arrow":
+        from backend_arrow import ArrowBackend, ParquetNotReadyError
+        app.add_exception_handler(ParquetNotReadyError, handle_backend_not_ready)
+        return ArrowBackend(fallback=SQLBackend())
+    raise ValueError(f"Unknown ANALYTICS_BACKEND: {name}")
+
+
+backend = create_backend(ANALYTICS_BACKEND)
+snapshot_store = SnapshotStore(SNAPSHOT_PATH) if SERVING_MODE == "snapshot" else None
+
+
+async def respond(request: Request, endpoint: str, year_month: str, compute) -> Response:
+    """配信モードに応じて、スナップショットの本文かキャッシュ付きの計算結果を返す関数"""
+    if snapshot_store is not None:
+        return snapshot_response(snapshot_store, request, endpoint, year_month)
+    return await cached_json_response(request, endpoint, year_month, compute)
 
 
 # API①  
@@ -213,28 +480,34 @@ def build_store_summary_query(formatted_year_month: str) -> str:
 async def main():
     return {"message": "Hello World"}
 
-@app.get("/monthly-summary/{year_month}")
-async def get_monthly_summary(year_month: str):
-    # year_monthを 'YYYY-MM' 形式に変換
-    formatted_year_month = f"{year_month[:4]}-{year_month[4:6]}"
-    query = build_monthly_summary_query(formatted_year_month)
-    result = execute_query(query)
-    
-    if not result:
-        return {"error": "No data found for the specified year_month."}
-    
-    formatted_result = {
-                            "total_users": result[0]['Total_Users'],
-                            "total_meals":result[0]['Total_Stocks_Used']
-                        }
+
+# 運用確認用：レスポンスキャッシュのヒット数と、同時リクエストの相乗り（single-flight）の回数
+@app.get("/stats")
+async def get_stats():
+    return cache_stats()
+
+
+# Prometheus 形式のメトリクス（リクエスト数・レイテンシ・処理段階ごとの時間・SQL ごとの実行時間など）
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    metrics_SQL.registry.set("response_cache_entries", {}, len(response_cache))
+    return PlainTextResponse(metrics_SQL.registry.render(), media_type="text/plain; version=0.0.4")
+
+## 各エンドポイントのレスポンスを計算する関数（キャッシュがない場合だけ呼ばれる）
+async def compute_monthly_summary(year_month: str) -> dict:
+    """指定された年月の月間サマリーを計算する関数"""
+    # year_monthを整数の年月キーに変換し、1行だけ読んでそのままレスポンスの形に変換
+    formatted_result = await backend.monthly_summary(to_year_month_key(year_month), format_monthly_summary_row)
+
+    if not formatted_result:
+        return NO_DATA_ERROR
+
     return formatted_result
 
 
-# API②   
-@app.get("/usage-frequency/{year_month}")
-async def get_usage_frequency(year_month: str):
+async def compute_usage_frequency(year_month: str) -> dict:
     """
-    指定された年月の使用頻度データを取得し、整形して返すエンドポイント。
+    指定された年月の使用頻度データを取得し、整形して返す関数。
     
     Args:
         year_month (str): 'YYYYMM'形式の年月。
@@ -242,61 +515,235 @@ async def get_usage_frequency(year_month: str):
     Returns:
         dict: 整形された使用頻度データ。
     """
-    # 年月を 'YYYY-MM' 形式に変換
-    formatted_year_month = f"{year_month[:4]}-{year_month[4:6]}"
     # 前月を計算
     prev_year_month = get_previous_month(year_month)
-    formatted_prev_year_month = f"{prev_year_month[:4]}-{prev_year_month[4:6]}"
-    
-    # 現在の月と前月のクエリを構築
-    current_query = build_usage_frequency_query(formatted_year_month)
-    prev_query = build_usage_frequency_query(formatted_prev_year_month)
-    
-    # クエリを実行して結果を取得
-    current_result = execute_query(current_query)
-    previous_result = execute_query(prev_query)
+
+    year_month_key = to_year_month_key(year_month)
+
+    # 現在の月と前月をまとめて1回で取得し、月ごとに振り分ける
+    rows = await backend.usage_frequency(year_month_key, to_year_month_key(prev_year_month))
+    current_result = [row for row in rows if row['year_month'] == year_month_key]
+    previous_result = [row for row in rows if row['year_month'] != year_month_key]
 
     # 前月のデータがない場合でも処理を続行
-    formatted_result = format_usage_frequency_result(year_month, current_result, previous_result if previous_result else [])
+    with phase("format"):
+        formatted_result = format_usage_frequency_result(year_month, current_result, previous_result)
     return formatted_result
 
 
-# API③
-@app.get("/usage-group/{year_month}")
-async def get_usage_group(year_month: str):
-    formatted_year_month = f"{year_month[:4]}-{year_month[4:6]}"
-
-    # 年齢グループのクエリを構築
-    age_group_query = build_age_group_query(formatted_year_month)
-    # 店舗サマリーのクエリを構築
-    store_summary_query = build_store_summary_query(formatted_year_month)
+async def compute_usage_group(year_month: str) -> dict:
+    """指定された年月の店舗別・年代別の利用者数と利用食数を計算する関数"""
+    year_month_key = to_year_month_key(year_month)
 
-    # クエリを実行
-    age_group_result = execute_query(age_group_query)
-    store_summary_result = execute_query(store_summary_query)
+    # 店舗サマリーと年齢グループを同時に集計し（SQL の場合は別々の接続）、各行を group_data.json と同じ形式に直接変換
+    store_data, age_group_data = await asyncio.gather(
+        backend.store_summary(year_month_key, format_store_row),
+        backend.age_groups(year_month_key, format_age_group_row),
+    )
 
-    if not age_group_result and not store_summary_result:
-        return {"error": "No data found for the specified year_month."}
+    if not age_group_data and not store_data:
+        return NO_DATA_ERROR
 
-    # 結果を group_data.json と同じ形式で整形
     formatted_result = {
-            "store_data": [
-                {
-                    "store_id": item["STORE_ID"],
-                    "store": item["STORE"],
-                    "total_users": item["Users_Per_Store"],
-                    "total_meals": item["Stocks_Used_Per_Store"]
-                }
-                for item in store_summary_result
-            ],
-            "age_group_data": [
-                {
-                    "age_group": item["age_group"],
-                    "total_users": item["Users_Per_Age_Group"],
-                    "total_meals": item["Stocks_Used_Per_Age_Group"]
-                }
-                for item in age_group_result
-            ]
+            "store_data": store_data,
+            "age_group_data": age_group_data
     }
 
     return formatted_result
+
+
+async def compute_dashboard(year_month: str) -> bytes:
+    """
+    ダッシュボード1画面分（API①②③）をまとめて計算する関数。
+    3つの集計は別々の接続で同時に実行し、各エンドポイントのキャッシュ（変換済みの JSON）をそのまま連結して返す
+    """
+    monthly_summary, usage_frequency, usage_group = await asyncio.gather(
+        get_cached_entry("monthly-summary", year_month, compute_monthly_summary),
+        get_cached_entry("usage-frequency", year_month, compute_usage_frequency),
+        get_cached_entry("usage-group", year_month, compute_usage_group),
+    )
+    return join_dashboard(monthly_summary.body, usage_frequency.body, usage_group.body)
+
+
+# 時系列で返せる最大の月数
+MAX_RANGE_MONTHS = 120
+
+
+def build_series(months: list, rows: list, month_values: Callable) -> dict:
+    """
+    年月ごとの行を、months（先頭は範囲の前月）に沿った値のリストと前月比の成長率にまとめる関数。
+    month_values(row) は (total_users, total_meals) を返す。
+    """
+    values = {row['year_month']: month_values(row) for row in rows}
+    users = [values.get(to_year_month_key(month), (None, None))[0] for month in months]
+    meals = [values.get(to_year_month_key(month), (None, None))[1] for month in months]
+    return {
+        "total_users": users[1:],
+        "total_meals": meals[1:],
+        "total_users_gr": calculate_growth_series(users),
+        "total_meals_gr": calculate_growth_series(meals),
+    }
+
+
+async def compute_monthly_summary_range(from_month: str, to_month: str) -> dict:
+    """from_month〜to_month の月間サマリーを時系列（月ごとの配列）で計算する関数"""
+    # 先頭月の成長率を出すため、範囲の前月から読む
+    months = [get_previous_month(from_month)] + list_months(from_month, to_month)
+    rows = await backend.monthly_summary_range(to_year_month_key(months[0]), to_year_month_key(to_month))
+    with phase("format"):
+        series = build_series(months, rows, lambda row: (row['Total_Users'], row['Total_Stocks_Used']))
+    return {"months": months[1:], **series}
+
+
+async def compute_usage_group_range(from_month: str, to_month: str) -> dict:
+    """from_month〜to_month の店舗別・年代別の利用者数と利用食数を時系列で計算する関数"""
+    months = [get_previous_month(from_month)] + list_months(from_month, to_month)
+    from_key, to_key = to_year_month_key(months[0]), to_year_month_key(to_month)
+    store_rows, age_group_rows = await asyncio.gather(
+        backend.store_summary_range(from_key, to_key),
+        backend.age_groups_range(from_key, to_key),
+    )
+
+    with phase("format"):
+        return format_usage_group_series(months, store_rows, age_group_rows)
+
+
+def format_usage_group_series(months: list, store_rows: list, age_group_rows: list) -> dict:
+    """店舗別・年代別の範囲クエリの行を、店舗・年代ごとの時系列にまとめる関数"""
+    stores, age_groups = {}, {}
+    for row in store_rows:
+        stores.setdefault((row['STORE'], row['STORE_ID']), []).append(row)
+    for row in age_group_rows:
+        age_groups.setdefault(row['age_group'], []).append(row)
+
+    return {
+        "months": months[1:],
+        "store_data": [
+            {
+                "store_id": store_id,
+                "store": store,
+                **build_series(months, rows, lambda row: (row['Users_Per_Store'], row['Stocks_Used_Per_Store']))
+            }
+            for (store, store_id), rows in sorted(stores.items())
+        ],
+        "age_group_data": [
+            {
+                "age_group": age_group,
+                **build_series(months, rows, lambda row: (row['Users_Per_Age_Group'], row['Stocks_Used_Per_Age_Group']))
+            }
+            for age_group, rows in sorted(age_groups.items())
+        ],
+    }
+
+
+def validate_month_range(from_month: str, to_month: str) -> Optional[dict]:
+    """月の範囲が正しいかを確認し、誤りがあればエラーのレスポンスを返す関数"""
+    if from_month > to_month:
+        return {"error": "from must be earlier than or equal to to."}
+    if len(list_months(from_month, to_month)) > MAX_RANGE_MONTHS:
+        return {"error": f"The range must be {MAX_RANGE_MONTHS} months or less."}
+    return None
+
+
+# レスポンスは (エンドポイント, 年月, ETL世代) ごとにキャッシュし、ETag で 304 を返せるようにする
+# SERVING_MODE=snapshot の場合は事前計算済みのファイルから返す
+@app.get("/monthly-summary/{year_month}")
+async def get_monthly_summary(year_month: YearMonth, request: Request):
+    return await respond(request, "monthly-summary", year_month, compute_monthly_summary)
+
+
+# API②
+@app.get("/usage-frequency/{year_month}")
+async def get_usage_frequency(year_month: YearMonth, request: Request):
+    return await respond(request, "usage-frequency", year_month, compute_usage_frequency)
+
+
+# API③
+@app.get("/usage-group/{year_month}")
+async def get_usage_group(year_month: YearMonth, request: Request):
+    return await respond(request, "usage-group", year_month, compute_usage_group)
+
+
+# API①②③をまとめたダッシュボード用：1回のリクエストで3つのレスポンスを返す
+@app.get("/dashboard/{year_month}")
+async def get_dashboard(year_month: YearMonth, request: Request):
+    return await respond(request, "dashboard", year_month, compute_dashboard)
+
+
+# API①③の時系列版：例 /monthly-summary?from=202101&to=202412
+# 範囲内の全月を1回の集計で計算し、月ごとの配列と前月比の成長率(_gr)で返す
+@app.get("/monthly-summary")
+async def get_monthly_summary_range(
+    request: Request, from_month: FromMonth, to_month: ToMonth
+):
+    error = validate_month_range(from_month, to_month)
+    if error:
+        return error
+    return await cached_json_response(
+        request, "monthly-summary-range", from_month, compute_monthly_summary_range, to_month
+    )
+
+
+@app.get("/usage-group")
+async def get_usage_group_range(
+    request: Request, from_month: FromMonth, to_month: ToMonth
+):
+    error = validate_month_range(from_month, to_month)
+    if error:
+        return error
+    return await cached_json_response(
+        request, "usage-group-range", from_month, compute_usage_group_range, to_month
+    )
+
+
+# 集計キューブ：月の範囲 × 店舗・年代・性別の任意の絞り込みと集計軸の組み合わせ
+# 例: /cube?from=202401&to=202403&group_by=store,age_group,gender&gender=女性
+@app.get("/cube")
+async def get_cube(
+    from_month: FromMonth,
+    to_month: ToMonth,
+    group_by: str = "",
+    store_id: Optional[list[int]] = Query(None),
+    age_group: Optional[list[str]] = Query(None),
+    gender: Optional[list[str]] = Query(None),
+):
+    dimensions = [dimension.strip() for dimension in group_by.split(",") if dimension.strip()]
+    unknown = [dimension for dimension in dimensions if dimension not in cube_SQL.CUBE_DIMENSIONS]
+    if unknown:
+        return {"error": f"Unknown group_by: {', '.join(unknown)}. Use {', '.join(cube_SQL.CUBE_DIMENSIONS)}."}
+
+    usage_cube = await cube_SQL.cube.get()
+    with phase("format"):
+        rows = usage_cube.query(
+            to_year_month_key(from_month), to_year_month_key(to_month), dimensions,
+            store_ids=store_id, age_groups=age_group, genders=gender,
+        )
+    return {"from": from_month, "to": to_month, "group_by": dimensions, "rows": rows}
+
+
+# 明細の書き出し：1か月分の final_combined_data（表示名付き）を CSV / NDJSON で少しずつ送る
+# 例: /export/202401?format=ndjson&gzip=1
+@app.get("/export/{year_month}")
+async def get_export(
+    year_month: YearMonth,
+    export_format: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+    compress: bool = Query(False, alias="gzip"),
+):
+    # ファイルとして保存されるエンドポイントなので、エラーは 200 ではなくエラーのステータスコードで返す
+    # （200 だとクライアントやプロキシがエラーの JSON を書き出したファイルとして扱ってしまう）
+    year_month_key = to_year_month_key(year_month)
+    if not await fetch_scalar(EXPORT_MONTH_EXISTS_QUERY, {"year_month": year_month_key}):
+        return FastJSONResponse(NO_DATA_ERROR, status_code=404)
+    if not export_SQL.acquire_slot():
+        return FastJSONResponse(
+            {"error": "Too many exports in progress. Please retry later."},
+            status_code=429,
+            headers={"Retry-After": str(export_SQL.EXPORT_RETRY_AFTER)},
+        )
+
+    filename = f"final_combined_data_{year_month}.{export_format}" + (".gz" if compress else "")
+    return StreamingResponse(
+        export_SQL.ExportStream(year_month_key, export_format, compress),
+        media_type="application/gzip" if compress else export_SQL.EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
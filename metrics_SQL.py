@@ -0,0 +1,290 @@
+# metrics_SQL.py : リクエストごとの計測と Prometheus 形式のメトリクス
+# main_SQL.py のミドルウェアがリクエストごとに RequestMetrics を作り、処理中の各所から次を記録する。
+#   処理段階ごとの時間（sql: SQL の実行と行の変換 / format: レスポンスの形への整形 / encode: JSON への変換）
+#   SQL の種類（数値・文字列を ? に置き換えた文のハッシュ = fingerprint）ごとの実行時間・返した行数・VM ステップ数
+#   レスポンスキャッシュのヒット・ミス
+# 集計結果は GET /metrics で Prometheus のテキスト形式で返す。
+# PROFILING_ENABLED=1 で起動すると ?profile=1 を付けたリクエストでスタックのサンプリング結果（呼び出しツリー）を返す
+#
+# SQLite は「走査した行数」を返さないので、代わりに progress handler で数えた VM の命令数（SQL_VM_STEP_INTERVAL 単位）を記録する
+
+import contextvars
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+
+# ?profile=1 を受け付けるか（本番では必要なときだけ有効にする）
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+# スタックをサンプリングする間隔（ミリ秒）
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "1"))
+# VM の命令数を数える単位（この命令数ごとに1回 Python の関数が呼ばれる）。0 で数えない
+SQL_VM_STEP_INTERVAL = int(os.environ.get("SQL_VM_STEP_INTERVAL", "1000"))
+# リクエスト時間のヒストグラムの区切り（秒）
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# サンプリング時に「待機中」とみなすスタック先頭のファイル（スレッドプールの待ち受けやイベントループの select）
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+
+
+class MetricsRegistry:
+    """カウンター・ゲージ・ヒストグラムを保持し、Prometheus のテキスト形式で出力するもの"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = defaultdict(float)
+        self._histograms = {}
+
+    def describe(self, name: str, metric_type: str, help_text: str) -> None:
+        self._types[name] = metric_type
+        self._help[name] = help_text
+
+    def inc(self, name: str, labels: dict, value: float = 1.0) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] += value
+
+    def set(self, name: str, labels: dict, value: float) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name: str, labels: dict, value: float) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(DURATION_BUCKETS), 0.0, 0])
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted(self._histograms.items())
+        for name in sorted(self._types):
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {self._types[name]}")
+            for (metric, labels), value in values:
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+            for (metric, labels), (buckets, total, count) in histograms:
+                if metric == name:
+                    for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total:g}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: tuple) -> str:
+    """ラベルを Prometheus の {key="value"} 形式に変換する関数"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+registry = MetricsRegistry()
+registry.describe("http_requests_total", "counter", "Requests by endpoint (route path) and status code.")
+registry.describe("http_request_duration_seconds", "histogram", "Request latency by endpoint.")
+registry.describe("request_phase_seconds_total", "counter", "Time spent per phase (sql, format, encode) by endpoint.")
+registry.describe("sql_queries_total", "counter", "Executed SQL statements by fingerprint.")
+registry.describe("sql_query_seconds_total", "counter", "SQL execution time (including row mapping) by fingerprint.")
+registry.describe("sql_rows_returned_total", "counter", "Rows returned by fingerprint.")
+registry.describe("sql_vm_steps_total", "counter", "SQLite VM instructions executed by fingerprint (approximate scan cost).")
+registry.describe("sql_statement_info", "gauge", "Normalized SQL text of each fingerprint.")
+registry.describe("response_cache_requests_total", "counter", "Response cache lookups by endpoint and result (hit, miss).")
+registry.describe("single_flight_requests_total", "counter", "Cache misses that executed or joined (coalesced) a computation.")
+registry.describe("response_cache_entries", "gauge", "Entries currently held in the response cache.")
+
+
+class RequestMetrics:
+    """1リクエスト分の計測結果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = defaultdict(float)
+        self.queries = []
+        self.cache = []
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[name] += seconds
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("request_metrics", default=None)
+_vm_steps = threading.local()
+
+
+def start_request() -> tuple:
+    """リクエストの計測を始める関数。(RequestMetrics, 後で finish_request に渡すトークン) を返す"""
+    metrics = RequestMetrics()
+    return metrics, _current.set(metrics)
+
+
+def finish_request(metrics: RequestMetrics, token, endpoint: str, status: int, seconds: float) -> None:
+    """リクエストの計測結果をメトリクスに加える関数"""
+    _current.reset(token)
+    registry.inc("http_requests_total", {"endpoint": endpoint, "status": status})
+    registry.observe("http_request_duration_seconds", {"endpoint": endpoint}, seconds)
+    for name, phase_seconds in metrics.phases.items():
+        registry.inc("request_phase_seconds_total", {"endpoint": endpoint, "phase": name}, phase_seconds)
+    for result in metrics.cache:
+        registry.inc("response_cache_requests_total", {"endpoint": endpoint, "result": result})
+
+
+@contextmanager
+def phase(name: str):
+    """with phase("format"): の中の処理時間を現在のリクエストの処理段階 name に加える"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_phase(name, time.perf_counter() - started)
+
+
+def record_cache(result: str) -> None:
+    """レスポンスキャッシュの結果（hit / miss）を現在のリクエストに記録する関数"""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.cache.append(result)
+
+
+@lru_cache(maxsize=512)
+def fingerprint(query: str) -> tuple:
+    """SQL の数値・文字列を ? に置き換えて正規化し、(ハッシュ, 正規化した文) を返す関数"""
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", query)
+    normalized = re.sub(r"\b\d+\b", "?", normalized)
+    normalized = " ".join(normalized.split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=4).hexdigest(), normalized
+
+
+def count_vm_steps() -> int:
+    """progress handler（SQL_VM_STEP_INTERVAL 命令ごとに呼ばれる）。実行中のスレッドの命令数を加算する"""
+    _vm_steps.value = getattr(_vm_steps, "value", 0) + SQL_VM_STEP_INTERVAL
+    return 0
+
+
+class TrackedQuery:
+    """track_query の中で返した行数を受け取るもの"""
+
+    __slots__ = ("rows",)
+
+    def __init__(self):
+        self.rows = 0
+
+
+@contextmanager
+def track_query(query: str):
+    """with track_query(sql) as tracked: の中で実行した SQL の時間・行数（tracked.rows）・VM 命令数を記録する"""
+    tracked = TrackedQuery()
+    steps_before = getattr(_vm_steps, "value", 0)
+    started = time.perf_counter()
+    try:
+        yield tracked
+    finally:
+        seconds = time.perf_counter() - started
+        vm_steps = getattr(_vm_steps, "value", 0) - steps_before
+        query_id, normalized = fingerprint(query)
+        labels = {"fingerprint": query_id}
+        registry.inc("sql_queries_total", labels)
+        registry.inc("sql_query_seconds_total", labels, seconds)
+        registry.inc("sql_rows_returned_total", labels, tracked.rows)
+        registry.inc("sql_vm_steps_total", labels, vm_steps)
+        registry.set("sql_statement_info", {"fingerprint": query_id, "sql": normalized[:200]}, 1)
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.add_phase("sql", seconds)
+            with metrics._lock:
+                metrics.queries.append({
+                    "fingerprint": query_id,
+                    "sql": normalized[:200],
+                    "ms": round(seconds * 1000, 3),
+                    "rows": tracked.rows,
+                    "vm_steps": vm_steps,
+                })
+
+
+class StackSampler(threading.Thread):
+    """
+    一定間隔で全スレッドのスタックを記録し、呼び出しツリー（関数ごとのサンプル数）を作るもの。
+    プロセス全体を記録するので、同時に処理中の他のリクエストも含まれる
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.samples = 0
+        self._root = {}
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples += 1
+                node = self._root
+                for label in reversed(stack):
+                    entry = node.setdefault(label, [0, {}])
+                    entry[0] += 1
+                    node = entry[1]
+
+    def stop(self) -> dict:
+        """サンプリングを止め、サンプル数の1%以上を占める関数だけの呼び出しツリーを返す"""
+        self._stop_event.set()
+        self.join()
+        threshold = max(1, self.samples // 100)
+
+        def to_tree(node: dict) -> list:
+            return [
+                {"frame": label, "samples": count, "children": to_tree(children)}
+                for label, (count, children) in sorted(node.items(), key=lambda item: -item[1][0])
+                if count >= threshold
+            ]
+
+        return {"interval_ms": self.interval * 1000, "samples": self.samples, "tree": to_tree(self._root)}
+
+
+def start_profiler() -> StackSampler:
+    sampler = StackSampler(PROFILE_INTERVAL_MS / 1000)
+    sampler.start()
+    return sampler
+
+
+def profile_report(metrics: RequestMetrics, sampler: StackSampler, endpoint: str, status: int, seconds: float) -> dict:
+    """?profile=1 のレスポンス（処理段階ごとの時間・SQL・キャッシュ・呼び出しツリー）を作る関数"""
+    phases_ms = {name: round(value * 1000, 3) for name, value in metrics.phases.items()}
+    return {
+        "endpoint": endpoint,
+        "status": status,
+        "duration_ms": round(seconds * 1000, 3),
+        # sql は並列に実行した分も合計するので、duration_ms を超えることがある
+        "phases_ms": phases_ms,
+        "queries": metrics.queries,
+        "cache": metrics.cache,
+        "profile": sampler.stop(),
+    }
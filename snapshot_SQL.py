@@ -0,0 +1,182 @@
+# snapshot_SQL.py : API レスポンスのスナップショット（事前計算済みファイル）の作成と読み込み
+# DB から全ての月のレスポンスを計算し、JSON に変換済みの本文を1つのファイルにまとめて保存する。
+# main_SQL.py を SERVING_MODE=snapshot で起動すると、このファイルを mmap して本文をそのまま返す
+# （リクエストごとの集計や JSON 変換は行わない）。
+#   python snapshot_SQL.py                 : DB から snapshot.bin を作成
+#   python snapshot_SQL.py --from-json     : main.py のダミーJSON（dummy_data.json など）から作成
+#
+# ファイル形式: MAGIC(8バイト) + ヘッダー長(8バイト, little endian) + ヘッダー(JSON) + 本文を連結したもの
+# ヘッダー: {"generation": ETL世代, "created_at": 作成日時, "entries": {"エンドポイント/年月": [開始位置, 長さ, ETag]}}
+# 開始位置は本文部分（ヘッダーの直後）の先頭からの位置
+
+import asyncio
+import json
+import mmap
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Optional
+from fastapi import Request, Response
+from cache_SQL import NO_DATA_ERROR, encode_json, etag_matches, join_dashboard, make_etag
+
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "snapshot.bin")
+MAGIC = b"PMUSNAP1"
+# スナップショットファイルが置き換わったかを確認する間隔（秒）
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("SNAPSHOT_CHECK_INTERVAL", "1.0"))
+
+# ダッシュボードに連結するエンドポイント（連結する順）
+DASHBOARD_PARTS = ("monthly-summary", "usage-frequency", "usage-group")
+# main.py が読み込んでいるダミーJSONとエンドポイントの対応
+DUMMY_JSON_FILES = {
+    "monthly-summary": "dummy_data.json",
+    "usage-frequency": "usage_frequency_data.json",
+    "usage-group": "group_data.json",
+}
+
+
+def write_snapshot(path: str, bodies: dict, generation: int) -> None:
+    """{"エンドポイント/年月": 本文(bytes)} をスナップショットファイルに書き出す関数。一時ファイルに書いてから置き換える"""
+    entries = {}
+    offset = 0
+    for key, body in bodies.items():
+        entries[key] = [offset, len(body), make_etag(body)]
+        offset += len(body)
+    header = json.dumps({
+        "generation": generation,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "entries": entries,
+    }, ensure_ascii=False).encode("utf-8")
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(MAGIC)
+        file.write(len(header).to_bytes(8, "little"))
+        file.write(header)
+        for body in bodies.values():
+            file.write(body)
+    os.replace(temp_path, path)
+
+
+class SnapshotReader:
+    """スナップショットファイルを mmap して、キーから本文と ETag を引けるようにしたもの"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.stat = os.fstat(file.fileno())
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a snapshot file")
+        header_length = int.from_bytes(self._mmap[len(MAGIC):len(MAGIC) + 8], "little")
+        header = json.loads(self._mmap[len(MAGIC) + 8:len(MAGIC) + 8 + header_length])
+        self._body_start = len(MAGIC) + 8 + header_length
+        self.generation = header["generation"]
+        self.created_at = header["created_at"]
+        self._entries = header["entries"]
+
+    def get(self, key: str) -> Optional[tuple]:
+        """キー("エンドポイント/年月")に対応する (本文, ETag) を返す。なければ None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        offset, length, etag = entry
+        start = self._body_start + offset
+        return self._mmap[start:start + length], etag
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+class SnapshotStore:
+    """現在のスナップショットを保持し、ファイルが置き換わったら読み直して差し替えるもの"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.reader = SnapshotReader(path)
+        self._checked_at = time.monotonic()
+
+    def current(self) -> SnapshotReader:
+        now = time.monotonic()
+        if now - self._checked_at >= SNAPSHOT_CHECK_INTERVAL:
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self.reader
+            if (stat.st_ino, stat.st_mtime_ns) != (self.reader.stat.st_ino, self.reader.stat.st_mtime_ns):
+                old_reader, self.reader = self.reader, SnapshotReader(self.path)
+                old_reader.close()
+        return self.reader
+
+
+def snapshot_response(store: SnapshotStore, request: Request, endpoint: str, year_month: str) -> Response:
+    """スナップショットの本文を ETag 付きでそのまま返す関数。該当する年月がなければライブ配信（main_SQL.py）と同じエラーを返す"""
+    found = store.current().get(f"{endpoint}/{year_month}")
+    if found is None:
+        return Response(
+            content=encode_json(NO_DATA_ERROR),
+            media_type="application/json",
+        )
+    body, etag = found
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+## スナップショットの作成
+def add_dashboards(bodies: dict) -> None:
+    """API①②③の本文が揃っている月について、それらを連結したダッシュボードの本文を bodies に追加する関数"""
+    months = {key.split("/", 1)[1] for key in bodies if key.startswith("monthly-summary/")}
+    for year_month in sorted(months):
+        parts = [bodies.get(f"{endpoint}/{year_month}") for endpoint in DASHBOARD_PARTS]
+        if all(part is not None for part in parts):
+            bodies[f"dashboard/{year_month}"] = join_dashboard(*parts)
+
+
+async def render_from_database() -> tuple:
+    """DB にある全ての月について API①②③とダッシュボードのレスポンスを計算する関数"""
+    import db_SQL
+    import main_SQL
+    from cache_SQL import get_generation
+
+    generation = await get_generation()
+    months = [str(row["year_month"]) for row in await db_SQL.fetch_all(
+        "SELECT year_month FROM monthly_summary ORDER BY year_month"
+    )]
+    bodies = {}
+    for year_month in months:
+        monthly_summary, usage_frequency, usage_group = await asyncio.gather(
+            main_SQL.compute_monthly_summary(year_month),
+            main_SQL.compute_usage_frequency(year_month),
+            main_SQL.compute_usage_group(year_month),
+        )
+        bodies[f"monthly-summary/{year_month}"] = encode_json(monthly_summary)
+        bodies[f"usage-frequency/{year_month}"] = encode_json(usage_frequency)
+        bodies[f"usage-group/{year_month}"] = encode_json(usage_group)
+    add_dashboards(bodies)
+    db_SQL.shutdown()
+    return bodies, generation
+
+
+def render_from_dummy_json() -> dict:
+    """main.py と同じダミーJSONファイルから API①②③とダッシュボードのレスポンスを作成する関数"""
+    bodies = {}
+    for endpoint, filename in DUMMY_JSON_FILES.items():
+        with open(filename, "r") as file:
+            data = json.load(file)
+        for year_month, content in data.items():
+            bodies[f"{endpoint}/{year_month}"] = encode_json(content)
+    add_dashboards(bodies)
+    return bodies
+
+
+if __name__ == "__main__":
+    if "--from-json" in sys.argv[1:]:
+        bodies, generation = render_from_dummy_json(), 0
+    else:
+        bodies, generation = asyncio.run(render_from_database())
+    write_snapshot(SNAPSHOT_PATH, bodies, generation)
+    print(f"{SNAPSHOT_PATH} を作成しました（{len(bodies)} 件, 世代 {generation}）。")